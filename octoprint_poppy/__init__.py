@@ -1,15 +1,31 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import collections
+import math
+import os
+import re
+import socket
+import threading
+import time
 import octoprint.plugin
 from octoprint.events import Events
-from octoprint.util import RepeatedTimer
-from flask import make_response
+from flask import jsonify, make_response, request
+from smbus2 import SMBus
+from .aw9523 import AW9523
 from .emc2101 import EMC2101
+from .i2cdev import I2CDevBus
+from .i2ctrace import TraceRecorder
+from .inputmonitor import GpioEdgeSource, InputMonitor, PollingEdgeSource
+from .lights import AW9523LightBackend, PCA9685LightBackend
+from .mqtt import TelemetryExporter
 from .pca9685 import PCA9685
+from .thermal import ChamberThermalModel
 
 _I2C_BUS_NUMBER = 11
 _FAN_POLL_INTERVAL_SECONDS = 2
+_TIME_TO_TARGET_RESOLUTION_SECONDS = 10
+_HISTORY_LENGTH = 300 # 10 minutes at the fan poll interval
 
 _LIGHT_MODE_OFF = 0
 _LIGHT_MODE_LOW = 1
@@ -19,6 +35,37 @@ _LIGHT_MODE_HIGH = 3
 _PIN_RELAY = 0
 _PIN_LED = 1
 
+# G-code commands handled by the queuing hook; M106 and M107 only when addressed
+# to the configured chamber fan index.
+_GCODE_COMMANDS = frozenset(["M106", "M107", "M141", "M191", "M355"])
+_GCODE_PARAMETER_PATTERN = re.compile(r"([A-Z])(-?\d*\.?\d+)?")
+_CHAMBER_WAIT_TOLERANCE = 1
+
+def _gcode_parameters(cmd):
+    # Skips the command itself, e.g. "M141 S45" yields {"S": 45.0}.
+    return dict((letter, float(value) if value else None)
+            for letter, value in _GCODE_PARAMETER_PATTERN.findall(cmd.upper())[1:])
+
+class _CharacterizationAborted(Exception):
+    pass
+
+def _downsample_history(samples, now):
+    # The hardware daemon samples faster than the fan poll.  Keep the latest
+    # sample of each fan poll interval over the history window, so that clients
+    # get the same span and number of samples as from the plugin's own history.
+    start = now - _HISTORY_LENGTH * _FAN_POLL_INTERVAL_SECONDS
+    result = []
+    last_slot = None
+    for t, temperature, fan_speed in samples:
+        if t < start:
+            continue
+        slot = min(int((t - start) / _FAN_POLL_INTERVAL_SECONDS), _HISTORY_LENGTH - 1)
+        if slot == last_slot:
+            result.pop()
+        result.append((t, round(temperature, 1), fan_speed))
+        last_slot = slot
+    return result
+
 class PoppyPlugin(
     octoprint.plugin.StartupPlugin,
     octoprint.plugin.ShutdownPlugin,
@@ -30,97 +77,466 @@ class PoppyPlugin(
 ):
 
     def __init__(self):
+        self._trace_recorder = None
+        self._daemon = None
+        self._exporter = None
+
         self._fan = None
-        self._fan_poll_timer = None
+        self._fan_thread = None
+        self._fan_stopping = False
+        self._fan_wakeup = threading.Event()
+        self._fan_lock = threading.Lock()
+        self._fan_target_changed = False
+        self._fan_profile_changed = False
+        self._fan_characterize_requested = False
+        self._fan_characterizing = False
 
         self._io = None
         self._relay_pin = None
-        self._led_pin = None
+        self._light_backends = []
+        self._light_zone_scales = {}
+        self._light_zone_levels = {} # zones set apart from the light mode
+        self._light_lock = threading.Lock()
+
+        self._aw9523 = None
+        self._inputs = None
+        self._input_monitor = None
+        self._input_edge_source = None
+        self._input_states = {}
 
         self._heating = False
-        self._heating_changed = False
+        self._printing = False
+        self._cooldown_deadline = None
+        self._slicer_chamber_target_temperature = None
+        self._gcode_chamber_target_temperature = None
+        self._gcode_fan_duty_cycle = None
+        self._chamber_wait = None
 
         self._chamber_light_mode = _LIGHT_MODE_OFF
         self._chamber_temperature = None
         self._chamber_fan_speed = None
+        self._chamber_time_to_target = None
+        self._chamber_target = None
+        self._chamber_fan_status = None
+        self._psu_on = False
+
+        self._state = {}
+        self._state_version = 0
+        # Distinguishes ETags across restarts, when the version starts over.
+        self._state_nonce = os.urandom(4).hex()
+        self._state_lock = threading.Lock()
+        self._thermal_model = ChamberThermalModel()
+        self._chamber_history = collections.deque(maxlen = _HISTORY_LENGTH)
+
+    ##~~ I2C bus
+
+    def _open_bus(self):
+        if self._settings.get(["i2c_transport"]) == "smbus2":
+            bus = SMBus(_I2C_BUS_NUMBER)
+        else:
+            bus = I2CDevBus(_I2C_BUS_NUMBER)
+        if self._trace_recorder:
+            bus = self._trace_recorder.wrap(bus)
+        return bus
+
+    def _init_trace(self):
+        # Record all I2C traffic when a trace file is configured, for replaying
+        # it later with i2ctrace.TraceReplay.
+        path = self._settings.get(["i2c_trace_file"])
+        if not path:
+            return
+        try:
+            path = os.path.join(self.get_plugin_data_folder(), path)
+            self._trace_recorder = TraceRecorder(path)
+            self._logger.info("Recording I2C traffic to %s", path)
+        except Exception:
+            self._logger.error("Failed to start recording I2C traffic", exc_info = True)
+            self._trace_recorder = None
+
+    def _release_trace(self):
+        if self._trace_recorder:
+            self._trace_recorder.close()
+            self._trace_recorder = None
+
+    ##~~ hardware daemon
+
+    def _init_daemon(self):
+        # In daemon mode a separate process owns the fan controller and the I/O
+        # expander, and the plugin drives them through proxies.
+        if not self._settings.get_boolean(["hardware_daemon"]):
+            return
+        try:
+            # Imported here as it needs multiprocessing.shared_memory, which is
+            # only available from Python 3.8.
+            from .daemon import HardwareDaemon
+            self._daemon = HardwareDaemon(_I2C_BUS_NUMBER,
+                    self._settings.get(["i2c_transport"]), self._logger)
+            self._daemon.start()
+        except Exception:
+            self._logger.error("Failed to start the hardware daemon", exc_info = True)
+            self._release_daemon()
+
+    def _release_daemon(self):
+        if self._daemon:
+            self._daemon.stop()
+            self._daemon = None
+
+    def _init_exporter(self):
+        # Publishes telemetry snapshots over MQTT from its own thread, fed from
+        # the state snapshot.
+        if not self._settings.get_boolean(["mqtt_enabled"]):
+            return
+        try:
+            self._exporter = TelemetryExporter(
+                    self._settings.get(["mqtt_host"]),
+                    self._settings.get_int(["mqtt_port"]),
+                    self._settings.get(["mqtt_client_id"]) or "poppy-%s" % socket.gethostname(),
+                    self._settings.get(["mqtt_topic_prefix"]),
+                    self._logger,
+                    username = self._settings.get(["mqtt_username"]) or None,
+                    password = self._settings.get(["mqtt_password"]) or None,
+                    interval = self._settings.get_int(["mqtt_interval"]))
+            self._exporter.start()
+        except Exception:
+            self._logger.error("Failed to start the MQTT exporter", exc_info = True)
+            self._exporter = None
+
+    def _release_exporter(self):
+        if self._exporter:
+            self._exporter.stop()
+            self._exporter = None
 
     ##~~ fan control
 
     def _init_fan(self):
         try:
-            self._fan = EMC2101(_I2C_BUS_NUMBER)
+            profile = self._settings.get(["fan_profile"])
+            if self._daemon:
+                self._fan = self._daemon.fan()
+                if profile:
+                    self._fan.fan_profile = profile
+            else:
+                self._fan = EMC2101(self._open_bus(), fan_profile = profile)
         except Exception:
             self._logger.error("Failed to initialize the fan controller", exc_info = True)
             self._fan = None
             return
-        self._fan_poll_timer = RepeatedTimer(_FAN_POLL_INTERVAL_SECONDS, self._poll_fan, run_first = True)
-        self._fan_poll_timer.start()
+        self._fan_stopping = False
+        self._fan_target_changed = True
+        self._fan_thread = threading.Thread(target = self._run_fan_worker, name = "poppy-fan")
+        self._fan_thread.daemon = True
+        self._fan_thread.start()
 
     def _release_fan(self):
         if self._fan:
-            self._fan_poll_timer.cancel()
-            self._fan_poll_timer = None
+            self._fan_stopping = True
+            self._fan_wakeup.set()
+            self._fan_thread.join()
+            self._fan_thread = None
             self._fan.close()
-            self._fan = None
+            # Nothing would release a job held by M191 without the fan worker.
+            with self._fan_lock:
+                self._fan = None
+                waiting = self._chamber_wait is not None
+                self._chamber_wait = None
+            if waiting:
+                self._logger.warning("Fan controller released, resuming the print")
+                self._release_job_hold()
+
+    def _request_fan_update(self):
+        # Wake the worker so that it applies the new target right away instead
+        # of on its next scheduled poll.
+        with self._fan_lock:
+            self._fan_target_changed = True
+        self._fan_wakeup.set()
+
+    def _request_fan_profile_update(self):
+        with self._fan_lock:
+            self._fan_profile_changed = True
+        self._fan_wakeup.set()
+
+    def _request_fan_characterization(self):
+        # Returns False if characterization is not possible or already under way,
+        # or while the fan is needed for a chamber wait or a cooldown.
+        with self._fan_lock:
+            if (not self._fan or not hasattr(self._fan, "characterize")
+                    or self._fan_characterize_requested or self._fan_characterizing
+                    or self._chamber_wait is not None or self._cooldown_deadline is not None):
+                return False
+            self._fan_characterize_requested = True
+        self._fan_wakeup.set()
+        return True
+
+    def _run_fan_worker(self):
+        # All fan controller bus traffic happens on this thread.  The worker
+        # polls on a fixed schedule and whenever it is woken up to apply a new
+        # target, in which case it polls immediately and restarts the schedule.
+        next_poll = time.monotonic()
+        while True:
+            self._fan_wakeup.wait(max(next_poll - time.monotonic(), 0))
+            self._fan_wakeup.clear()
+            if self._fan_stopping:
+                break
+            with self._fan_lock:
+                target_changed = self._fan_target_changed
+                self._fan_target_changed = False
+                profile_changed = self._fan_profile_changed
+                self._fan_profile_changed = False
+                characterize = self._fan_characterize_requested
+                self._fan_characterize_requested = False
+            if characterize:
+                self._characterize_fan()
+            elif profile_changed:
+                self._apply_fan_profile()
+            if target_changed:
+                self._update_fan_target_temperature()
+            self._check_deadlines(self._poll_fan())
+            next_poll = time.monotonic() + _FAN_POLL_INTERVAL_SECONDS
+
+    def _characterize_fan(self):
+        # Blocks the worker for the duration of the measurement; the driver
+        # restores the previous target when done.  Aborted between measurements
+        # when the plugin shuts down or a print starts, so that neither waits
+        # for the sweep to end.
+        with self._fan_lock:
+            self._fan_characterizing = True
+        self._notify_clients()
+        self._logger.info("Characterizing the chamber fan")
+
+        def progress():
+            if self._fan_stopping or self._printing:
+                raise _CharacterizationAborted()
+            self._check_deadlines(True)
+
+        try:
+            profile = self._fan.characterize(progress = progress)
+        except _CharacterizationAborted:
+            self._logger.info("Fan characterization aborted")
+            profile = None
+        except Exception:
+            self._logger.error("Failed to characterize the chamber fan", exc_info = True)
+            profile = None
+        if profile:
+            self._logger.info("Fan profile: stall at %s%%, start at %s%%, max %s RPM",
+                profile["stall_duty"], profile["start_duty"], profile["max_rpm"])
+            self._settings.set(["fan_profile"], profile)
+            self._settings.save()
+            self._apply_fan_profile()
+        with self._fan_lock:
+            self._fan_characterizing = False
+        self._notify_clients()
+
+    def _apply_fan_profile(self):
+        try:
+            self._fan.fan_profile = self._settings.get(["fan_profile"])
+        except Exception:
+            self._logger.error("Failed to apply the fan profile", exc_info = True)
 
+    # Returns whether the telemetry is fresh.
     def _poll_fan(self):
-        if self._heating_changed:
-            self._heating_changed = False
-            self._update_fan_target_temperature()
         if self._fan:
             try:
                 self._fan.poll()
             except Exception:
                 self._logger.error("Failed to poll the fan controller", exc_info = True)
-                return
+                return False
             self._logger.debug("fan: int %s, ext %s, tgt %s, spd %s, status %s",
                 self._fan.internal_temperature,
                 self._fan.external_temperature,
                 self._fan.target_temperature,
                 self._fan.fan_speed,
                 self._fan.status)
+            time_to_target = self._estimate_time_to_target()
+            # The hardware daemon keeps its own history at its poll rate.
+            if not self._daemon:
+                self._chamber_history.append((time.monotonic(),
+                        self._fan.external_temperature, self._fan.fan_speed))
             if (self._chamber_temperature != self._fan.external_temperature 
-                    or self._chamber_fan_speed != self._fan.fan_speed):
+                    or self._chamber_fan_speed != self._fan.fan_speed
+                    or self._chamber_time_to_target != time_to_target
+                    or self._chamber_target != self._fan.target_temperature
+                    or self._chamber_fan_status != self._fan.status):
                 self._chamber_temperature = self._fan.external_temperature
                 self._chamber_fan_speed = self._fan.fan_speed
+                self._chamber_time_to_target = time_to_target
+                self._chamber_target = self._fan.target_temperature
+                self._chamber_fan_status = dict(self._fan.status)
                 self._notify_clients()
+            return True
+        return False
+
+    def _estimate_time_to_target(self):
+        self._thermal_model.update(time.monotonic(), self._fan.external_temperature,
+                self._heating, self._fan.fan_speed)
+        if self._fan.forced_duty_cycle is not None:
+            return None
+        seconds = self._thermal_model.time_to_target(self._fan.target_temperature,
+                self._heating, self._fan.fan_speed)
+        if seconds is None:
+            return None
+        return int(math.ceil(seconds / _TIME_TO_TARGET_RESOLUTION_SECONDS)) * _TIME_TO_TARGET_RESOLUTION_SECONDS
 
     def _update_fan_target_temperature(self):
         if self._fan:
             try:
-                self._fan.target_temperature = self._settings.get_int([
-                    "chamber_target_temperature_when_heating" if self._heating else
-                    "chamber_target_temperature_when_cooling"])
-                self._logger.info("new target temperature %s, heating %s",
-                        self._fan.target_temperature, self._heating)
+                self._fan.target_temperature = self._chamber_target_temperature()
+                self._fan.forced_duty_cycle = (100 if self._cooldown_deadline is not None
+                        else self._gcode_fan_duty_cycle)
+                self._logger.info("new target temperature %s, heating %s, printing %s, cooldown %s",
+                        self._fan.target_temperature, self._heating, self._printing,
+                        self._cooldown_deadline is not None)
             except Exception:
                 self._logger.error("Failed to update fan controller target temperature", exc_info = True)
 
+    def _chamber_target_temperature(self):
+        # A target set by G-code takes precedence until the print ends.
+        if self._gcode_chamber_target_temperature:
+            return self._gcode_chamber_target_temperature
+
+        # Preheat the chamber as soon as the print starts rather than waiting
+        # for the bed to report a target.
+        if self._heating or (self._printing and
+                self._settings.get_boolean(["chamber_preheat_when_printing"])):
+            if self._slicer_chamber_target_temperature:
+                return self._slicer_chamber_target_temperature
+            return self._settings.get_int(["chamber_target_temperature_when_heating"])
+        return self._settings.get_int(["chamber_target_temperature_when_cooling"])
+
+    # Called by the fan worker after every poll, even a failed one, and during
+    # characterization, so that deadlines pass while readings are unavailable.
+    def _check_deadlines(self, polled):
+        self._check_cooldown_finished(polled)
+        self._check_chamber_wait_finished(polled)
+
+    def _check_cooldown_finished(self, polled):
+        # Force-cool at full speed until the chamber reaches the cooling target
+        # or the cooldown period expires, whichever comes first.  The new target
+        # is applied by the worker, after characterization if one is running.
+        with self._fan_lock:
+            if self._cooldown_deadline is None:
+                return
+            cooled = polled and (self._fan.external_temperature
+                    <= self._settings.get_int(["chamber_target_temperature_when_cooling"]))
+            if not cooled and time.monotonic() < self._cooldown_deadline:
+                return
+            self._cooldown_deadline = None
+            self._fan_target_changed = True
+        self._logger.info("Chamber cooldown finished")
+        self._fan_wakeup.set()
+
+    def _check_chamber_wait_finished(self, polled):
+        # Release the job held by M191 once the chamber is within tolerance of
+        # the target, or when the wait times out.
+        with self._fan_lock:
+            if self._chamber_wait is None:
+                return
+            target, settle, deadline = self._chamber_wait
+            reached = False
+            if polled:
+                temperature = self._fan.external_temperature
+                if settle:
+                    reached = abs(temperature - target) <= _CHAMBER_WAIT_TOLERANCE
+                else:
+                    reached = temperature >= target - _CHAMBER_WAIT_TOLERANCE
+            if not reached and time.monotonic() < deadline:
+                return
+            self._chamber_wait = None
+        if reached:
+            self._logger.info("Chamber reached %s, resuming the print", target)
+        else:
+            self._logger.warning("Timed out waiting for the chamber to reach %s, resuming the print", target)
+        self._release_job_hold()
+        self._notify_clients()
+
+    def _release_job_hold(self):
+        # The printer raises when it is not connected, which must not stop the
+        # fan worker or the rest of the shutdown.
+        try:
+            self._printer.set_job_on_hold(False)
+        except Exception:
+            self._logger.error("Failed to release the job held for the chamber", exc_info = True)
+
     ##~~ light and relay control
 
     def _init_io(self):
         try:
-            self._io = PCA9685(_I2C_BUS_NUMBER)
+            self._io = self._daemon.io() if self._daemon else PCA9685(self._open_bus())
         except Exception:
             self._logger.error("Failed to initialize the I/O expander", exc_info = True)
             self._io = None
             return
         self._io.reset()
         self._relay_pin = self._io.pin(_PIN_RELAY)
-        self._led_pin = self._io.pin(_PIN_LED)
 
     def _release_io(self):
         if self._io:
             self._relay_pin = None
-            self._led_pin = None
             self._io.reset()
             self._io.close()
             self._io = None
 
+    def _get_aw9523(self):
+        # The AW9523 is shared by the light zones and the inputs, reset once.
+        if not self._aw9523:
+            aw9523 = AW9523(self._open_bus())
+            aw9523.reset()
+            self._aw9523 = aw9523
+        return self._aw9523
+
+    def _release_aw9523(self):
+        if self._aw9523:
+            self._aw9523.close()
+            self._aw9523 = None
+
+    def _init_lights(self):
+        # Group the zones by chip so that each backend updates all of its zones
+        # in one burst.
+        zones = {}
+        for zone in self._settings.get(["light_zones"]) or []:
+            name = zone["name"]
+            zones.setdefault(zone.get("chip", "pca9685"), {})[name] = [int(c) for c in zone["channels"]]
+            self._light_zone_scales[name] = zone.get("scale", 100)
+        for chip, chip_zones in zones.items():
+            try:
+                if chip == "pca9685":
+                    if not self._io:
+                        raise AttributeError("PCA9685 not available")
+                    if any(_PIN_RELAY in channels for channels in chip_zones.values()):
+                        raise AttributeError("Channel %s drives the power supply relay" % _PIN_RELAY)
+                    backend = PCA9685LightBackend(self._io, chip_zones)
+                elif chip == "aw9523":
+                    backend = AW9523LightBackend(self._get_aw9523(), chip_zones)
+                else:
+                    raise AttributeError("Unknown light chip %s" % chip)
+            except Exception:
+                self._logger.error("Failed to initialize the %s light zones", chip, exc_info = True)
+                continue
+            self._light_backends.append(backend)
+
+    def _release_lights(self):
+        with self._light_lock:
+            for backend in self._light_backends:
+                try:
+                    backend.close()
+                except Exception:
+                    self._logger.error("Failed to turn off the light zones", exc_info = True)
+            self._light_backends = []
+
     def _update_chamber_light(self):
-        brightness = self._chamber_light_brightness_for_mode(self._chamber_light_mode)
-        if self._led_pin:
-            self._led_pin.duty_cycle = int(max(min(brightness * 4096 / 100, 4096), 0))
+        # Callers hold _light_lock.  Backends only write the zones that changed.
+        for backend in self._light_backends:
+            try:
+                backend.set_levels(dict((name, self._light_zone_level(name)) for name in backend.zones))
+            except Exception:
+                self._logger.error("Failed to update the light zones", exc_info = True)
+
+    def _light_zone_level(self, name):
+        # Zones follow the light mode, scaled, unless set on their own.
+        level = self._light_zone_levels.get(name)
+        if level is None:
+            brightness = self._chamber_light_brightness_for_mode(self._chamber_light_mode)
+            level = brightness * self._light_zone_scales[name] / 100
+        return level
 
     def _chamber_light_brightness_for_mode(self, mode):
         if mode <= _LIGHT_MODE_OFF:
@@ -131,6 +547,52 @@ class PoppyPlugin(
             return self._settings.get_int(["chamber_light_brightness_medium"])
         return self._settings.get_int(["chamber_light_brightness_high"])
 
+    ##~~ input monitoring
+
+    def _init_inputs(self):
+        inputs = self._settings.get(["inputs"]) or []
+        if not inputs:
+            return
+        try:
+            self._inputs = self._get_aw9523()
+            gpio_line = self._settings.get(["input_interrupt_gpio_line"])
+            if gpio_line is not None:
+                self._input_edge_source = GpioEdgeSource(
+                        self._settings.get(["input_interrupt_gpio_chip"]), int(gpio_line))
+            else:
+                self._logger.info("No interrupt line configured, polling the inputs instead")
+                self._input_edge_source = PollingEdgeSource()
+            self._input_monitor = InputMonitor(self._inputs, self._input_edge_source)
+            names = {}
+            for input in inputs:
+                pin = int(input["pin"])
+                names[pin] = input.get("name") or "input%s" % pin
+                self._input_monitor.add_pin(pin,
+                        lambda pin, state: self._on_input_changed(names[pin], pin, state))
+            self._input_monitor.start()
+            self._input_states = dict((name, self._input_monitor.state(pin)) for pin, name in names.items())
+        except Exception:
+            self._logger.error("Failed to initialize input monitoring", exc_info = True)
+            self._release_inputs()
+
+    def _release_inputs(self):
+        if self._input_monitor:
+            self._input_monitor.stop()
+            self._input_monitor = None
+        if self._input_edge_source:
+            self._input_edge_source.close()
+            self._input_edge_source = None
+        self._inputs = None
+
+    def _on_input_changed(self, name, pin, state):
+        self._logger.info("Input %s (pin %s) changed to %s", name, pin, state)
+        self._input_states[name] = state
+        try:
+            self._event_bus.fire("plugin_poppy_input_changed", dict(name = name, pin = pin, state = state))
+            self._notify_clients()
+        except Exception:
+            self._logger.error("Failed to dispatch input change", exc_info = True)
+
     ##~~ StartupPlugin mixin
 
     def on_startup(self, host, port):
@@ -139,16 +601,28 @@ class PoppyPlugin(
             helpers["register_plugin"](self)
 
     def on_after_startup(self):
+        self._init_trace()
+        self._init_daemon()
         self._init_fan()
-        self._update_fan_target_temperature()
         self._init_io()
-        self._update_chamber_light()
+        self._init_lights()
+        with self._light_lock:
+            self._update_chamber_light()
+        self._init_inputs()
+        self._init_exporter()
+        self._notify_clients()
 
     ##~~ ShutdownPlugin mixin
 
     def on_shutdown(self):
+        self._release_exporter()
         self._release_fan()
+        self._release_lights()
         self._release_io()
+        self._release_inputs()
+        self._release_aw9523()
+        self._release_daemon()
+        self._release_trace()
 
     ##~~ SettingsPlugin mixin
 
@@ -156,30 +630,103 @@ class PoppyPlugin(
         return {
             "chamber_target_temperature_when_heating": 40,
             "chamber_target_temperature_when_cooling": 30,
+            "chamber_preheat_when_printing": True,
+            "chamber_cooldown_when_done": True,
+            "chamber_cooldown_max_duration": 900,
             "chamber_light_brightness_low": 10,
             "chamber_light_brightness_medium": 50,
-            "chamber_light_brightness_high": 100
+            "chamber_light_brightness_high": 100,
+            "light_zones": [{"name": "chamber", "chip": "pca9685", "channels": [_PIN_LED]}],
+            "inputs": [],
+            "input_interrupt_gpio_chip": "/dev/gpiochip0",
+            "input_interrupt_gpio_line": None,
+            "i2c_transport": "smbus2",
+            "hardware_daemon": False,
+            "i2c_trace_file": None,
+            "fan_profile": None,
+            "gcode_commands": True,
+            "gcode_chamber_fan_index": None,
+            "chamber_wait_timeout": 1800,
+            "mqtt_enabled": False,
+            "mqtt_host": "localhost",
+            "mqtt_port": 1883,
+            "mqtt_username": None,
+            "mqtt_password": None,
+            "mqtt_client_id": None,
+            "mqtt_topic_prefix": "poppy",
+            "mqtt_interval": 5
         }
 
+    def get_settings_restricted_paths(self):
+        return dict(admin = [["mqtt_username"], ["mqtt_password"]])
+
     def on_settings_save(self, data):
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
-        self._update_fan_target_temperature()
-        self._update_chamber_light()
+        self._request_fan_update()
+        with self._light_lock:
+            self._update_chamber_light()
 
     ##~~ EventHandlerPlugin mixin
 
     def on_event(self, event, payload):
         if event == Events.CLIENT_OPENED:
             self._notify_clients()
+        elif event == Events.PRINT_STARTED:
+            with self._fan_lock:
+                self._printing = True
+                self._cooldown_deadline = None
+            self._request_fan_update()
+        elif event == Events.PRINT_DONE or event == Events.PRINT_FAILED:
+            cooldown = self._settings.get_boolean(["chamber_cooldown_when_done"])
+            duration = self._settings.get_int(["chamber_cooldown_max_duration"])
+            with self._fan_lock:
+                self._printing = False
+                self._slicer_chamber_target_temperature = None
+                self._gcode_chamber_target_temperature = None
+                self._gcode_fan_duty_cycle = None
+                self._cooldown_deadline = time.monotonic() + duration if cooldown else None
+                waiting = self._chamber_wait is not None
+                self._chamber_wait = None
+            if waiting:
+                self._release_job_hold()
+            self._request_fan_update()
 
     def _notify_clients(self):
-        data = {}
-        if self._chamber_temperature != None:
-            data["chamber_temperature"] = self._chamber_temperature
-        if self._chamber_fan_speed != None:
-            data["chamber_fan_speed"] = self._chamber_fan_speed
-        data["chamber_light_mode"] = self._chamber_light_mode
-        self._plugin_manager.send_plugin_message(self._identifier, data)
+        # Notifications come from several threads.  Building, storing and pushing
+        # the state under one lock keeps a slower thread from storing or pushing
+        # an older state after a newer one.
+        with self._state_lock:
+            data = {}
+            if self._chamber_temperature != None:
+                data["chamber_temperature"] = self._chamber_temperature
+            if self._chamber_fan_speed != None:
+                data["chamber_fan_speed"] = self._chamber_fan_speed
+            if self._chamber_target != None:
+                data["chamber_target_temperature"] = self._chamber_target
+            if self._chamber_fan_status != None:
+                data["fan_status"] = self._chamber_fan_status
+            data["chamber_time_to_target"] = self._chamber_time_to_target
+            data["chamber_light_mode"] = self._chamber_light_mode
+            data["light_zones"] = dict((name, round(self._light_zone_level(name)))
+                    for name in self._light_zone_scales)
+            data["psu"] = self._psu_on
+            data["chamber_waiting"] = self._chamber_wait is not None
+            data["fan_characterizing"] = self._fan_characterizing
+            data["fan_profile"] = self._settings.get(["fan_profile"]) is not None
+            if self._input_states:
+                data["inputs"] = dict(self._input_states)
+            self._update_state(data)
+            self._plugin_manager.send_plugin_message(self._identifier, data)
+
+    def _update_state(self, data):
+        # Callers hold _state_lock.  Keep a snapshot of the last state pushed to
+        # clients so that the REST API can serve it without touching the bus.
+        if data == self._state:
+            return
+        self._state = data
+        self._state_version += 1
+        if self._exporter:
+            self._exporter.offer(data)
 
     # ~~ BlueprintPlugin mixin
 
@@ -188,6 +735,110 @@ class PoppyPlugin(
         self.toggle_chamber_light_mode()
         return make_response('', 200)
 
+    @octoprint.plugin.BlueprintPlugin.route("/state", methods=["GET"])
+    def handle_get_state_request(self):
+        # Supports conditional requests with If-None-Match.  Never blocks: Flask
+        # handlers run on OctoPrint's single server thread.
+        etag = request.headers.get("If-None-Match")
+        with self._state_lock:
+            current_etag = self._state_etag()
+            state = self._state
+        if etag == current_etag:
+            response = make_response('', 304)
+        else:
+            response = jsonify(state)
+        response.headers["ETag"] = current_etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    @octoprint.plugin.BlueprintPlugin.route("/state", methods=["PUT"])
+    def handle_put_state_request(self):
+        # Applies several changes at once with a single hardware update.  Accepts
+        # any of chamber_light_mode, light_zones, psu,
+        # chamber_target_temperature_when_heating and
+        # chamber_target_temperature_when_cooling.  light_zones maps zone names
+        # to levels in percent, or to null to follow the light mode again, and
+        # is applied after chamber_light_mode.
+        data = request.get_json(silent = True)
+        if not isinstance(data, dict):
+            return make_response("Expected a JSON object", 400)
+        try:
+            light_mode = int(data["chamber_light_mode"]) if "chamber_light_mode" in data else None
+            zone_levels = dict((name, None if level is None else int(level))
+                    for name, level in data["light_zones"].items()) if "light_zones" in data else {}
+            psu = bool(data["psu"]) if "psu" in data else None
+            targets = dict((key, int(data[key])) for key in [
+                    "chamber_target_temperature_when_heating",
+                    "chamber_target_temperature_when_cooling"] if key in data)
+        except (AttributeError, TypeError, ValueError):
+            return make_response("Invalid value", 400)
+        if any(name not in self._light_zone_scales for name in zone_levels):
+            return make_response("Unknown light zone", 400)
+
+        if light_mode is not None or zone_levels:
+            with self._light_lock:
+                changed = light_mode is not None and self._set_chamber_light_mode(light_mode)
+                for name, level in zone_levels.items():
+                    changed = self._set_light_zone_level(name, level) or changed
+                if changed:
+                    self._update_chamber_light()
+        if psu is not None:
+            self._set_psu_state(psu)
+        if targets:
+            for key, value in targets.items():
+                self._settings.set_int([key], value)
+            self._settings.save()
+            self._request_fan_update()
+        self._notify_clients()
+        with self._state_lock:
+            response = jsonify(self._state)
+            response.headers["ETag"] = self._state_etag()
+        return response
+
+    def _state_etag(self):
+        return '"%s-%s"' % (self._state_nonce, self._state_version)
+
+    @octoprint.plugin.BlueprintPlugin.route("/chamber/estimate", methods=["GET"])
+    def handle_chamber_estimate_request(self):
+        return jsonify(
+            chamber_temperature = self._chamber_temperature,
+            chamber_target_temperature = self._fan.target_temperature if self._fan else None,
+            chamber_time_to_target = self._chamber_time_to_target)
+
+    @octoprint.plugin.BlueprintPlugin.route("/fan/characterize", methods=["POST"])
+    def handle_fan_characterize_request(self):
+        # Runs in the background; clients follow fan_characterizing in the state.
+        # Characterization takes over the fan, so it is refused while printing.
+        if self._printer.is_printing() or not self._request_fan_characterization():
+            return make_response("Fan characterization not available", 409)
+        return make_response('', 202)
+
+    @octoprint.plugin.BlueprintPlugin.route("/fan/profile", methods=["DELETE"])
+    def handle_fan_profile_delete_request(self):
+        # Reverts to the default fan parameters.
+        self._settings.set(["fan_profile"], None)
+        self._settings.save()
+        self._request_fan_profile_update()
+        self._notify_clients()
+        return make_response('', 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/chamber/history", methods=["GET"])
+    def handle_chamber_history_request(self):
+        # Report sample ages rather than timestamps so that clients can place them
+        # on their own clock.  The daemon and the plugin share the monotonic clock.
+        now = time.monotonic()
+        daemon = self._daemon
+        if daemon:
+            try:
+                samples = _downsample_history(daemon.samples(), now)
+            except RuntimeError:
+                self._logger.error("Failed to read the hardware daemon's history", exc_info = True)
+                samples = []
+        else:
+            samples = list(self._chamber_history)
+        return jsonify(samples = [[round(now - t, 1), temperature, fan_speed]
+                for t, temperature, fan_speed in samples])
+
     ##~~ AssetPlugin mixin
 
     def get_assets(self):
@@ -208,10 +859,17 @@ class PoppyPlugin(
     ##~~ Temperatures hook
 
     def get_temperatures(self, comm, parsed_temps):
-        heating = parsed_temps.get("B", (0, 0))[1] > 0
+        heating = (parsed_temps.get("B", (0, 0))[1] or 0) > 0
         if self._heating != heating:
             self._heating = heating
-            self._heating_changed = True
+            self._request_fan_update()
+
+        # Follow the chamber target set by the slicer when the firmware reports one.
+        chamber_target = (parsed_temps.get("C", (0, 0))[1] or 0)
+        chamber_target = int(chamber_target) if chamber_target > 0 else None
+        if self._slicer_chamber_target_temperature != chamber_target:
+            self._slicer_chamber_target_temperature = chamber_target
+            self._request_fan_update()
 
         if self._fan:
             parsed_temps["fan_controller"] = (self._fan.internal_temperature, None)
@@ -219,6 +877,96 @@ class PoppyPlugin(
             parsed_temps["_chamber"] = (self._fan.external_temperature, self._fan.target_temperature)
         return parsed_temps
 
+    ##~~ G-code queuing hook
+
+    def handle_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        # Handles chamber and light commands from slicer scripts locally and keeps
+        # them from reaching the printer:
+        #   M141 S<temp>           set the chamber target until the print ends, S0 to clear
+        #   M191 S<temp>|R<temp>   same, then hold the job until the chamber has warmed
+        #                          up to the target (S) or settled at it (R)
+        #   M355 S<0|1> [P<0-255>] switch the chamber light, P picks the nearest mode
+        #   M106 P<index> S<0-255> drive the chamber fan at a fixed duty cycle
+        #   M107 P<index>          return the chamber fan to temperature control
+        if gcode not in _GCODE_COMMANDS or not self._settings.get_boolean(["gcode_commands"]):
+            return None
+        parameters = _gcode_parameters(cmd)
+        if gcode == "M106" or gcode == "M107":
+            index = self._settings.get_int(["gcode_chamber_fan_index"])
+            if index is None or parameters.get("P") != index:
+                return None
+            self._handle_gcode_fan(parameters.get("S", 255) if gcode == "M106" else None)
+        elif gcode == "M141" or gcode == "M191":
+            settle = "S" not in parameters and "R" in parameters
+            target = parameters.get("R" if settle else "S")
+            if target is None:
+                return None
+            self._handle_gcode_chamber_target(int(target), gcode == "M191", settle)
+        elif gcode == "M355":
+            self._handle_gcode_light(parameters.get("S"), parameters.get("P"))
+        return (None,)
+
+    def _handle_gcode_fan(self, value):
+        with self._fan_lock:
+            self._gcode_fan_duty_cycle = (None if value is None
+                    else min(max(round(value * 100 / 255), 0), 100))
+        self._request_fan_update()
+
+    def _handle_gcode_chamber_target(self, target, wait, settle):
+        with self._fan_lock:
+            self._gcode_chamber_target_temperature = target if target > 0 else None
+        self._request_fan_update()
+        if not wait or target <= 0:
+            return
+        if not self._fan or not self._printer.is_printing():
+            self._logger.warning("Not waiting for the chamber to reach %s", target)
+            return
+
+        # Hold the job rather than blocking the queue so that the printer keeps
+        # communicating; the fan worker releases the hold.  Not blocking also
+        # keeps this from deadlocking against the job's own queuing.
+        try:
+            held = self._printer.set_job_on_hold(True, blocking = False)
+        except Exception:
+            self._logger.error("Failed to hold the job", exc_info = True)
+            held = False
+        if not held:
+            self._logger.warning("Could not hold the job to wait for the chamber to reach %s", target)
+            return
+        timeout = self._settings.get_int(["chamber_wait_timeout"])
+        with self._fan_lock:
+            # The fan controller may have been released in the meantime.
+            available = self._fan is not None
+            replaced = self._chamber_wait is not None
+            if available:
+                self._chamber_wait = (target, settle, time.monotonic() + timeout)
+        if replaced or not available:
+            self._release_job_hold()
+        if not available:
+            self._logger.warning("Not waiting for the chamber to reach %s", target)
+            return
+        self._logger.info("Waiting for the chamber to reach %s", target)
+        self._request_fan_update()
+        self._notify_clients()
+
+    def _handle_gcode_light(self, state, brightness):
+        if state is not None and state <= 0:
+            mode = _LIGHT_MODE_OFF
+        elif brightness is None:
+            mode = _LIGHT_MODE_HIGH if state else self._chamber_light_mode
+        elif brightness <= 0:
+            mode = _LIGHT_MODE_OFF
+        else:
+            percent = brightness * 100 / 255
+            mode = min([_LIGHT_MODE_LOW, _LIGHT_MODE_MEDIUM, _LIGHT_MODE_HIGH],
+                    key = lambda m: abs(self._chamber_light_brightness_for_mode(m) - percent))
+        self.set_chamber_light_mode(mode)
+
+    ##~~ Custom events hook
+
+    def register_custom_events(self, *args, **kwargs):
+        return ["input_changed"]
+
     ##~~ Softwareupdate hook
 
     def get_update_information(self):
@@ -244,38 +992,87 @@ class PoppyPlugin(
     ##~~ PSU Control plug-in
 
     def turn_psu_on(self):
-        self._logger.info("Switching power supply on")
-        if self._relay_pin:
-            self._relay_pin.state = True
+        self._set_psu_state(True)
+        self._notify_clients()
 
     def turn_psu_off(self):
-        self._logger.info("Switching power supply off")
+        self._set_psu_state(False)
+        self._notify_clients()
+
+    def _set_psu_state(self, state):
+        self._logger.info("Switching power supply %s", "on" if state else "off")
+        self._psu_on = state
         if self._relay_pin:
-            self._relay_pin.state = False
+            self._relay_pin.state = state
 
     def get_psu_state(self):
-        return self._relay_pin.state if self._relay_pin else False
+        return self._psu_on if self._relay_pin else False
 
     ##~~ Helpers
 
     def get_chamber_temperature(self):
         return self._chamber_temperature if self._chamber_temperature != None else 0
 
+    def get_chamber_time_to_target(self):
+        return self._chamber_time_to_target
+
     def set_chamber_light_mode(self, mode):
+        with self._light_lock:
+            changed = self._set_chamber_light_mode(mode)
+            if changed:
+                self._update_chamber_light()
+        if changed:
+            self._notify_clients()
+
+    def _set_chamber_light_mode(self, mode):
+        # Callers hold _light_lock and update the lights.  Setting the mode
+        # brings zones set on their own back to following it.
         if mode < _LIGHT_MODE_OFF:
             mode = _LIGHT_MODE_OFF
         if mode > _LIGHT_MODE_HIGH:
             mode = _LIGHT_MODE_HIGH
-        if mode == self._chamber_light_mode:
-            return
+        if mode == self._chamber_light_mode and not self._light_zone_levels:
+            return False
 
         self._logger.info("Setting chamber light mode to %s", mode)
         self._chamber_light_mode = mode
-        self._update_chamber_light()
-        self._notify_clients()
+        self._light_zone_levels = {}
+        return True
     
     def toggle_chamber_light_mode(self):
-        self.set_chamber_light_mode(self._chamber_light_mode - 1 if self._chamber_light_mode > _LIGHT_MODE_OFF else _LIGHT_MODE_HIGH)
+        with self._light_lock:
+            changed = self._set_chamber_light_mode(self._chamber_light_mode - 1
+                    if self._chamber_light_mode > _LIGHT_MODE_OFF else _LIGHT_MODE_HIGH)
+            if changed:
+                self._update_chamber_light()
+        if changed:
+            self._notify_clients()
+
+    # Set the level of one light zone in percent, or None to have it follow the
+    # light mode again.
+    def set_light_zone_level(self, name, level):
+        with self._light_lock:
+            changed = self._set_light_zone_level(name, level)
+            if changed:
+                self._update_chamber_light()
+        if changed:
+            self._notify_clients()
+
+    def _set_light_zone_level(self, name, level):
+        # Callers hold _light_lock and update the lights.
+        if name not in self._light_zone_scales:
+            raise AttributeError("Unknown light zone %s" % name)
+        if level is not None:
+            level = min(max(int(level), 0), 100)
+        if level == self._light_zone_levels.get(name):
+            return False
+
+        self._logger.info("Setting light zone %s to %s", name, level)
+        if level is None:
+            del self._light_zone_levels[name]
+        else:
+            self._light_zone_levels[name] = level
+        return True
 
 
 __plugin_pythoncompat__ = ">=3,<4" # only python 3
@@ -287,12 +1084,16 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.comm.protocol.temperatures.received": (__plugin_implementation__.get_temperatures, 1),
+        "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.handle_gcode_queuing,
+        "octoprint.events.register_custom_events": __plugin_implementation__.register_custom_events,
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
     }
 
     global __plugin_helpers__
     __plugin_helpers__ = dict(
         get_chamber_temperature = __plugin_implementation__.get_chamber_temperature,
+        get_chamber_time_to_target = __plugin_implementation__.get_chamber_time_to_target,
         set_chamber_light_mode = __plugin_implementation__.set_chamber_light_mode,
-        toggle_chamber_light_mode = __plugin_implementation__.toggle_chamber_light_mode
+        toggle_chamber_light_mode = __plugin_implementation__.toggle_chamber_light_mode,
+        set_light_zone_level = __plugin_implementation__.set_light_zone_level
     )
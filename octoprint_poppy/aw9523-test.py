@@ -2,7 +2,9 @@
 # coding=utf-8
 from __future__ import absolute_import
 from aw9523 import AW9523
+from inputmonitor import GpioEdgeSource, InputMonitor, PollingEdgeSource
 import sys
+import time
 
 def main():
     with AW9523(11) as io:
@@ -25,6 +27,20 @@ def main():
             pin = io.led_pin(n)
             pin.level = level
             print("led pin %s: level %s" % (n, level))
+        elif len(sys.argv) >= 3 and sys.argv[1] == "monitor":
+            # monitor <pins> [<gpio chip> <gpio line>], e.g. "monitor 0,1 /dev/gpiochip0 17"
+            pins = [int(n) for n in sys.argv[2].split(",")]
+            source = GpioEdgeSource(sys.argv[3], int(sys.argv[4])) if len(sys.argv) == 5 else PollingEdgeSource()
+            monitor = InputMonitor(io, source)
+            for n in pins:
+                monitor.add_pin(n, lambda n, state: print("input pin %s: state %s" % (n, state)))
+            monitor.start()
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                monitor.stop()
+                source.close()
         else:
             print("Unrecognized command.")
             sys.exit(1)
@@ -2,6 +2,10 @@
 from __future__ import absolute_import
 import math
 from smbus2 import SMBus, i2c_msg
+try:
+    from .i2cdev import prepare_block_read, prepare_block_write
+except ImportError:
+    from i2cdev import prepare_block_read, prepare_block_write
 
 # Refer to datasheet: https://cdn-shop.adafruit.com/product-files/4886/AW9523+English+Datasheet.pdf
 _CHIP_ADDRESS = 0x58
@@ -10,16 +14,18 @@ _CHIP_ID = 0x23
 _REGISTER_PORT_INPUT_BASE = 0x00
 _REGISTER_PORT_OUTPUT_BASE = 0x02
 _REGISTER_PORT_DIRECTION_BASE = 0x04
-#_REGISTER_PORT_INTERRUPT_BASE = 0x06
-_REGISTER_CONTROL = 0x07
+_REGISTER_PORT_INTERRUPT_BASE = 0x06
+_REGISTER_CONTROL = 0x11
 _REGISTER_ID = 0x10
 _REGISTER_PORT_MODE_BASE = 0x12
 _REGISTER_PORT_CURRENT_BASE = 0x20
 _REGISTER_RESET = 0x7f
 
 class AW9523():
-    def __init__(self, bus_number):
-        self._bus = SMBus(bus_number)
+    def __init__(self, bus):
+        # Accepts an I2C bus number or an already open SMBus-like object.
+        self._bus = SMBus(bus) if isinstance(bus, int) else bus
+        self._inputs_read = prepare_block_read(self._bus, _CHIP_ADDRESS, _REGISTER_PORT_INPUT_BASE, 2)
         self._check_chip_id()
     
     def _check_chip_id(self):
@@ -35,6 +41,15 @@ class AW9523():
         # Set drive current to 1/4 (~9.25 mA).
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_CONTROL, 0x13)
 
+        # Disable change interrupts on all pins until they are requested.
+        self._bus.write_i2c_block_data(_CHIP_ADDRESS, _REGISTER_PORT_INTERRUPT_BASE, [0xff, 0xff])
+
+    # Read the state of all pins in one transaction as a 16-bit value with pin 0 in bit 0.
+    # Reading the inputs also clears a pending change interrupt.
+    def read_inputs(self):
+        data = self._inputs_read.execute()
+        return data[0] | (data[1] << 8)
+
     def input_pin(self, pin):
         if pin < 0 or pin > 15:
             raise AttributeError("Invalid pin number")
@@ -55,6 +70,10 @@ class AW9523():
         self._write_port_bit(pin, _REGISTER_PORT_MODE_BASE, False)
         return AW9523.LedPin(self, pin)
 
+    # Prepare a write of consecutive registers, relying on auto-increment.
+    def prepare_register_write(self, register, length):
+        return prepare_block_write(self._bus, _CHIP_ADDRESS, register, length)
+
     def _read_port_bit(self, pin, base_reg):
         reg = base_reg if pin < 8 else base_reg + 1
         bit = 1 << (pin & 7)
@@ -89,6 +108,20 @@ class AW9523():
         def state(self):
             return self._io._read_port_bit(self._pin, _REGISTER_PORT_INPUT_BASE)
 
+        @property
+        def pin(self):
+            return self._pin
+
+        # Interrupt enabled: True to assert the INT line when the input changes
+        @property
+        def interrupt_enabled(self):
+            # The register bit is set to disable the interrupt.
+            return not self._io._read_port_bit(self._pin, _REGISTER_PORT_INTERRUPT_BASE)
+
+        @interrupt_enabled.setter
+        def interrupt_enabled(self, value):
+            self._io._write_port_bit(self._pin, _REGISTER_PORT_INTERRUPT_BASE, not value)
+
     class OutputPin():
         def __init__(self, io, pin):
             self._io = io
@@ -114,6 +147,11 @@ class AW9523():
             else:
                 self._reg = _REGISTER_PORT_CURRENT_BASE + pin
 
+        # Current control register of the pin
+        @property
+        def register(self):
+            return self._reg
+
         # LED current level: 0 (no current) to 255 (maximum current)
         def level(self, value):
             value = int(value)
@@ -0,0 +1,456 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+# Runs the fan controller and I/O expander in a separate worker process so that
+# bus stalls and sampling do not compete with OctoPrint's threads for the GIL.
+#
+# The daemon publishes telemetry into shared memory guarded by a sequence lock:
+# the writer makes the sequence odd while updating and even when done, readers
+# retry until they see the same even sequence before and after reading.  The
+# shared memory holds the latest snapshot followed by a ring of recent samples.
+# Commands travel over a pipe.  The plugin talks to the daemon through proxies
+# that mimic the EMC2101 and PCA9685 drivers, and a supervisor thread restarts
+# the daemon if it dies, replaying the last commanded state.
+
+_SEQUENCE = struct.Struct("<I")
+_SNAPSHOT = struct.Struct("<dffIBIBB")
+_RING_COUNT = struct.Struct("<Q")
+_SAMPLE = struct.Struct("<dfI")
+_RING_LENGTH = 1200 # 10 minutes at the default poll interval
+
+_SNAPSHOT_OFFSET = _SEQUENCE.size
+_RING_COUNT_OFFSET = _SNAPSHOT_OFFSET + _SNAPSHOT.size
+_RING_OFFSET = _RING_COUNT_OFFSET + _RING_COUNT.size
+_SHARED_MEMORY_SIZE = _RING_OFFSET + _SAMPLE.size * _RING_LENGTH
+
+_STATUS_FLAGS = [
+    "internal_temperature_high",
+    "external_temperature_low",
+    "external_temperature_high",
+    "external_temperature_critical",
+    "external_temperature_fault",
+    "tach_fault"
+]
+
+_DEFAULT_POLL_INTERVAL_SECONDS = 0.5
+_STALE_POLL_INTERVALS = 4
+_READ_TIMEOUT_SECONDS = 0.05
+_STARTUP_TIMEOUT_SECONDS = 10
+_RESTART_DELAY_SECONDS = 1
+_MAX_RESTART_DELAY_SECONDS = 30
+
+class _TelemetryWriter():
+    def __init__(self, buffer):
+        # Carry on from a previous daemon, keeping the samples it recorded.
+        self._buffer = buffer
+        # A daemon that died while writing left the sequence odd.
+        self._sequence = _SEQUENCE.unpack_from(buffer, 0)[0]
+        self._sequence += self._sequence & 1
+        self._samples = _RING_COUNT.unpack_from(buffer, _RING_COUNT_OFFSET)[0]
+
+    def publish(self, timestamp, fan, errors, fan_available, io_available):
+        status = 0
+        internal_temperature = external_temperature = 0
+        fan_speed = 0
+        if fan:
+            internal_temperature = fan.internal_temperature
+            external_temperature = fan.external_temperature
+            fan_speed = fan.fan_speed
+            for bit, name in enumerate(_STATUS_FLAGS):
+                if fan.status[name]:
+                    status |= 1 << bit
+
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._buffer, 0, self._sequence)
+        _SNAPSHOT.pack_into(self._buffer, _SNAPSHOT_OFFSET, timestamp, internal_temperature,
+                external_temperature, fan_speed, status, errors, fan_available, io_available)
+        if fan:
+            _SAMPLE.pack_into(self._buffer, _RING_OFFSET + (self._samples % _RING_LENGTH) * _SAMPLE.size,
+                    timestamp, external_temperature, fan_speed)
+            self._samples += 1
+            _RING_COUNT.pack_into(self._buffer, _RING_COUNT_OFFSET, self._samples)
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._buffer, 0, self._sequence)
+
+class _TelemetryReader():
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    # Gives up when the sequence stays odd, which happens when the daemon dies
+    # while writing, until its replacement publishes.
+    def _read(self, fn):
+        deadline = time.monotonic() + _READ_TIMEOUT_SECONDS
+        while True:
+            before = _SEQUENCE.unpack_from(self._buffer, 0)[0]
+            if not before & 1:
+                result = fn()
+                if _SEQUENCE.unpack_from(self._buffer, 0)[0] == before:
+                    return before, result
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out reading the hardware daemon telemetry")
+            time.sleep(0)
+
+    # Returns the sequence number and the snapshot tuple.
+    def snapshot(self):
+        return self._read(lambda: _SNAPSHOT.unpack_from(self._buffer, _SNAPSHOT_OFFSET))
+
+    # Returns up to the last _RING_LENGTH samples as (time, temperature, fan speed) tuples.
+    def samples(self):
+        def read():
+            count = _RING_COUNT.unpack_from(self._buffer, _RING_COUNT_OFFSET)[0]
+            return [_SAMPLE.unpack_from(self._buffer, _RING_OFFSET + (i % _RING_LENGTH) * _SAMPLE.size)
+                    for i in range(max(count - _RING_LENGTH, 0), count)]
+        return self._read(read)[1]
+
+def _run_daemon(connection, shared_memory_name, bus_number, transport, poll_interval, reset_io):
+    from .emc2101 import EMC2101
+    from .pca9685 import PCA9685
+
+    logger = logging.getLogger("octoprint.plugins.poppy.daemon")
+    memory = shared_memory.SharedMemory(name = shared_memory_name)
+    writer = _TelemetryWriter(memory.buf)
+
+    def open_bus():
+        if transport == "smbus2":
+            from smbus2 import SMBus
+            return SMBus(bus_number)
+        from .i2cdev import I2CDevBus
+        return I2CDevBus(bus_number)
+
+    fan = None
+    io = None
+    pins = {}
+    errors = 0
+    try:
+        fan = EMC2101(open_bus())
+    except Exception:
+        logger.error("Failed to initialize the fan controller", exc_info = True)
+    try:
+        io = PCA9685(open_bus())
+        if reset_io:
+            io.reset()
+    except Exception:
+        logger.error("Failed to initialize the I/O expander", exc_info = True)
+        io = None
+
+    def apply(command):
+        if command[0] == "fan" and fan:
+            fan.target_temperature = command[1]
+            fan.forced_duty_cycle = command[2]
+        elif command[0] == "fan_profile" and fan:
+            fan.fan_profile = command[1]
+        elif command[0] == "pin" and io:
+            channel, name, value = command[1:]
+            if channel not in pins:
+                pins[channel] = io.pin(channel)
+            setattr(pins[channel], name, value)
+        elif command[0] == "io_reset" and io:
+            io.reset()
+
+    try:
+        # Publish real telemetry from the start, the plugin cannot tell a
+        # snapshot of zeros from readings.
+        if fan:
+            try:
+                fan.poll()
+            except OSError:
+                errors += 1
+        writer.publish(time.monotonic(), fan, errors, fan is not None, io is not None)
+        next_poll = time.monotonic()
+        while True:
+            if connection.poll(max(next_poll - time.monotonic(), 0)):
+                try:
+                    command = connection.recv()
+                except EOFError:
+                    break
+                if command[0] == "shutdown":
+                    break
+                try:
+                    apply(command)
+                except OSError:
+                    errors += 1
+                    logger.error("Failed to apply command %s", command, exc_info = True)
+                continue
+            if fan:
+                try:
+                    fan.poll()
+                except OSError:
+                    errors += 1
+            writer.publish(time.monotonic(), fan, errors, fan is not None, io is not None)
+            next_poll = time.monotonic() + poll_interval
+    finally:
+        if fan:
+            fan.close()
+        if io:
+            io.close()
+        memory.close()
+
+class HardwareDaemon():
+    def __init__(self, bus_number, transport, logger, poll_interval = _DEFAULT_POLL_INTERVAL_SECONDS):
+        self._bus_number = bus_number
+        self._transport = transport
+        self._logger = logger
+        self._poll_interval = poll_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._memory = None
+        self._reader = None
+        self._process = None
+        self._connection = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._supervisor = None
+        self._fan_command = None
+        self._fan_profile_command = None
+        self._pin_commands = {}
+        self.restarts = 0
+
+    def start(self):
+        self._memory = shared_memory.SharedMemory(create = True, size = _SHARED_MEMORY_SIZE)
+        self._memory.buf[:_SHARED_MEMORY_SIZE] = bytes(_SHARED_MEMORY_SIZE)
+        self._reader = _TelemetryReader(self._memory.buf)
+        self._spawn(reset_io = True)
+        self._wait_for_startup()
+        self._supervisor = threading.Thread(target = self._supervise, name = "poppy-daemon-supervisor")
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._supervisor:
+            self._supervisor.join()
+            self._supervisor = None
+        if self._process:
+            with self._lock:
+                self._send_locked(("shutdown",))
+            self._process.join(_STARTUP_TIMEOUT_SECONDS)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+        if self._memory:
+            self._reader = None
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+    def _spawn(self, reset_io):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target = _run_daemon, name = "poppy-daemon",
+                args = (child_connection, self._memory.name, self._bus_number,
+                self._transport, self._poll_interval, reset_io))
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        with self._lock:
+            self._process = process
+            self._connection = parent_connection
+            # Bring a restarted daemon back to the last commanded state.
+            if self._fan_profile_command:
+                self._send_locked(self._fan_profile_command)
+            if self._fan_command:
+                self._send_locked(self._fan_command)
+            for command in self._pin_commands.values():
+                self._send_locked(command)
+
+    def _wait_for_startup(self):
+        deadline = time.monotonic() + _STARTUP_TIMEOUT_SECONDS
+        while self._reader.snapshot()[0] == 0:
+            if time.monotonic() > deadline or not self._process.is_alive():
+                raise RuntimeError("Hardware daemon failed to start")
+            time.sleep(0.05)
+
+    def _supervise(self):
+        delay = _RESTART_DELAY_SECONDS
+        started = time.monotonic()
+        while not self._stopping.is_set():
+            self._process.join(1)
+            if self._stopping.is_set() or self._process.is_alive():
+                continue
+            # Back off while the daemon keeps crashing soon after it starts.
+            if time.monotonic() - started > _MAX_RESTART_DELAY_SECONDS:
+                delay = _RESTART_DELAY_SECONDS
+            self._logger.error("Hardware daemon exited with code %s, restarting in %s s",
+                    self._process.exitcode, delay)
+            if self._stopping.wait(delay):
+                break
+            self.restarts += 1
+            self._spawn(reset_io = False)
+            started = time.monotonic()
+            delay = min(delay * 2, _MAX_RESTART_DELAY_SECONDS)
+
+    def _send(self, command):
+        with self._lock:
+            if command[0] == "fan":
+                self._fan_command = command
+            elif command[0] == "fan_profile":
+                self._fan_profile_command = command
+            elif command[0] == "pin":
+                self._pin_commands[command[1]] = command
+            self._send_locked(command)
+
+    def _send_locked(self, command):
+        # Commands sent while the daemon is down are replayed after the restart.
+        try:
+            self._connection.send(command)
+        except (OSError, EOFError):
+            pass
+
+    def snapshot(self):
+        return self._reader.snapshot()[1]
+
+    def samples(self):
+        return self._reader.samples()
+
+    def fan(self):
+        if not self.snapshot()[6]:
+            raise RuntimeError("Fan controller not available in the hardware daemon")
+        return RemoteFan(self)
+
+    def io(self):
+        if not self.snapshot()[7]:
+            raise RuntimeError("I/O expander not available in the hardware daemon")
+        return RemoteIO(self)
+
+class RemoteFan():
+    # Stands in for EMC2101, reading telemetry from the daemon's snapshot.
+    def __init__(self, daemon):
+        self._daemon = daemon
+        self._restarts = daemon.restarts
+        self._errors = 0
+        self._target_temperature = 0
+        self._forced_duty_cycle = None
+        self._fan_profile = None
+        self._internal_temperature = 0
+        self._external_temperature = 0
+        self._fan_speed = 0
+        self._status = dict((name, False) for name in _STATUS_FLAGS)
+
+    # Raises like EMC2101.poll when the daemon failed to poll the fan since the
+    # last call or stopped publishing, for example while it restarts.
+    def poll(self):
+        (timestamp, internal_temperature, external_temperature, fan_speed,
+                status, errors, fan_available, io_available) = self._daemon.snapshot()
+        if self._daemon.restarts != self._restarts:
+            # A restarted daemon counts errors from zero.
+            self._restarts = self._daemon.restarts
+            self._errors = 0
+        failed = errors > self._errors
+        self._errors = errors
+        age = time.monotonic() - timestamp
+        if age > self._daemon._poll_interval * _STALE_POLL_INTERVALS:
+            raise RuntimeError("Hardware daemon telemetry is %.1f s old" % age)
+        if failed:
+            raise RuntimeError("Hardware daemon failed to poll the fan controller")
+        self._internal_temperature = int(internal_temperature)
+        self._external_temperature = round(external_temperature, 1)
+        self._fan_speed = fan_speed
+        for bit, name in enumerate(_STATUS_FLAGS):
+            self._status[name] = bool(status & (1 << bit))
+
+    def close(self):
+        pass
+
+    def _send(self):
+        self._daemon._send(("fan", self._target_temperature, self._forced_duty_cycle))
+
+    @property
+    def internal_temperature(self):
+        return self._internal_temperature
+
+    @property
+    def external_temperature(self):
+        return self._external_temperature
+
+    @property
+    def target_temperature(self):
+        return self._target_temperature
+
+    @target_temperature.setter
+    def target_temperature(self, value):
+        value = int(value)
+        if value != self._target_temperature:
+            self._target_temperature = value
+            self._send()
+
+    @property
+    def forced_duty_cycle(self):
+        return self._forced_duty_cycle
+
+    @forced_duty_cycle.setter
+    def forced_duty_cycle(self, value):
+        if value is not None:
+            value = min(max(int(value), 0), 100)
+        if value != self._forced_duty_cycle:
+            self._forced_duty_cycle = value
+            self._send()
+
+    # Characterization needs direct control of the fan and is not offered remotely,
+    # but profiles are applied in the daemon.
+    @property
+    def fan_profile(self):
+        return self._fan_profile
+
+    @fan_profile.setter
+    def fan_profile(self, value):
+        self._fan_profile = value
+        self._daemon._send(("fan_profile", value))
+
+    @property
+    def fan_speed(self):
+        return self._fan_speed
+
+    @property
+    def status(self):
+        return self._status
+
+class RemoteIO():
+    # Stands in for PCA9685, forwarding pin changes to the daemon.
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def reset(self):
+        self._daemon._send(("io_reset",))
+
+    def pin(self, pin):
+        if pin < 0 or pin > 15:
+            raise AttributeError("Invalid pin number")
+        return RemoteIO.Pin(self._daemon, pin)
+
+    def close(self):
+        pass
+
+    class Pin():
+        def __init__(self, daemon, pin):
+            self._daemon = daemon
+            self._pin = pin
+            self._state = None
+            self._duty_cycle = None
+
+        # Last commanded state, the daemon does not read the pins back.
+        @property
+        def state(self):
+            return self._state
+
+        @state.setter
+        def state(self, value):
+            self._state = bool(value)
+            self._duty_cycle = 4096 if self._state else 0
+            self._daemon._send(("pin", self._pin, "state", self._state))
+
+        @property
+        def duty_cycle(self):
+            return self._duty_cycle
+
+        @duty_cycle.setter
+        def duty_cycle(self, value):
+            value = int(value)
+            if value < 0 or value > 4096:
+                raise AttributeError("Value must be between 0 and 4096")
+            self._duty_cycle = value
+            self._state = True if value == 4096 else False if value == 0 else None
+            self._daemon._send(("pin", self._pin, "duty_cycle", value))
@@ -1,7 +1,12 @@
 # coding=utf-8
 from __future__ import absolute_import
 import math
+import time
 from smbus2 import SMBus, i2c_msg
+try:
+    from .i2cdev import prepare_reads
+except ImportError:
+    from i2cdev import prepare_reads
 
 # Refer to datasheet: https://ww1.microchip.com/downloads/en/DeviceDoc/2101.pdf
 _CHIP_ADDRESS = 0x4c
@@ -52,15 +57,83 @@ _DEFAULT_TEMPERATURE_LIMITS = {
 
 _DEFAULT_TARGET_TEMPERATURE = 0
 
+# Fan parameters used without a characterization profile, suited to the
+# Noctua NF-A8: minimum of 400 RPM, spin-up at 50%, evenly spaced LUT duties.
+_DEFAULT_TACH_LIMIT_RPM = 400
+_DEFAULT_SPIN_UP_LEVEL = 50
+_DEFAULT_LUT_DUTY_CYCLES = [20, 40, 60, 80, 100]
+
+# Spin-up drive levels supported by the fan spin-up register, in percent.
+_SPIN_UP_LEVELS = [(50, 0x01), (75, 0x02), (100, 0x03)]
+
+_CHARACTERIZATION_STEPS = 20
+_CHARACTERIZATION_SETTLE_SECONDS = 3
+
+# Margins applied when deriving parameters from a profile: the tach limit sits
+# below the slowest stable speed and spin-up drives above the start duty.
+_TACH_LIMIT_MARGIN = 0.75
+_SPIN_UP_MARGIN = 10
+
 def _toSignedByte(x):
     return x if x < 128 else x - 256
 
+def _duty_to_setting(duty_cycle):
+    return math.ceil(duty_cycle * _PWM_FULL_DUTY / 100)
+
+def _rpm_to_tach(rpm):
+    return min(max(round(5400000 / rpm), 1), 0xfffe) if rpm > 0 else 0xffff
+
+# Interpolates the duty cycle that yields the given speed from running points
+# sorted by duty cycle.
+def _duty_for_rpm(points, rpm):
+    for (d0, r0), (d1, r1) in zip(points, points[1:]):
+        if r1 >= rpm:
+            if r1 <= r0:
+                return d1
+            return d0 + (d1 - d0) * max(rpm - r0, 0) / (r1 - r0)
+    return points[-1][0]
+
+# Derives the tach limit, spin-up level and LUT duty cycles from a profile as
+# returned by EMC2101.characterize, falling back to the defaults without one.
+def derive_fan_parameters(profile):
+    points = sorted((float(d), int(r)) for d, r in (profile or {}).get("points", []) if r > 0)
+    if len(points) < 2:
+        return _DEFAULT_TACH_LIMIT_RPM, _DEFAULT_SPIN_UP_LEVEL, list(_DEFAULT_LUT_DUTY_CYCLES)
+
+    # Only the part of the curve above the stall point gives stable control.
+    stall_duty = profile.get("stall_duty") or points[0][0]
+    points = [p for p in points if p[0] >= stall_duty] or points
+    min_rpm = points[0][1]
+    max_rpm = max(r for d, r in points)
+
+    tach_limit_rpm = int(min_rpm * _TACH_LIMIT_MARGIN)
+
+    start_duty = profile.get("start_duty") or 100
+    spin_up_level = next((level for level, bits in _SPIN_UP_LEVELS
+            if level >= start_duty + _SPIN_UP_MARGIN), 100)
+
+    # Space the LUT steps evenly in speed rather than in duty cycle.
+    steps = len(_DEFAULT_LUT_DUTY_CYCLES)
+    duty_cycles = []
+    for i in range(1, steps + 1):
+        rpm = min_rpm + (max_rpm - min_rpm) * i / steps
+        duty = max(math.ceil(_duty_for_rpm(points, rpm)), math.ceil(stall_duty))
+        duty_cycles.append(min(max(duty, duty_cycles[-1] if duty_cycles else 0), 100))
+    duty_cycles[-1] = 100
+    return tach_limit_rpm, spin_up_level, duty_cycles
+
 class EMC2101():
-    def __init__(self, bus_number):
-        self._bus = SMBus(bus_number)
+    def __init__(self, bus, fan_profile = None):
+        # Accepts an I2C bus number or an already open SMBus-like object, and
+        # optionally a fan profile as returned by characterize.
+        self._bus = SMBus(bus) if isinstance(bus, int) else bus
         self._internal_temperature = 0
         self._external_temperature = 0
         self._target_temperature = _DEFAULT_TARGET_TEMPERATURE
+        self._forced_duty_cycle = None
+        self._fan_profile = fan_profile
+        self._tach_limit_rpm, self._spin_up_level, self._lut_duty_cycles = \
+                derive_fan_parameters(fan_profile)
         self._temperature_limits = _DEFAULT_TEMPERATURE_LIMITS
         self._fan_speed = 0
         self._status = {
@@ -72,8 +145,20 @@ class EMC2101():
             "tach_fault": False
         }
 
+        # Read all telemetry registers in one prepared transaction.  The external
+        # temperature MSB is read before the LSB to latch it, whereas the tach LSB
+        # is read before the MSB (yes, this is the opposite of external temperature).
+        self._telemetry = prepare_reads(self._bus, _CHIP_ADDRESS, [
+            _REGISTER_TEMP_INTERNAL,
+            _REGISTER_TEMP_EXTERNAL_MSB,
+            _REGISTER_TEMP_EXTERNAL_LSB,
+            _REGISTER_TACH_READING_LSB,
+            _REGISTER_TACH_READING_MSB,
+            _REGISTER_STATUS])
+
         self._check_chip_id()
         self._configure_static()
+        self._configure_fan()
         self._configure_temperature_limits()
         self._configure_temperature_target()
     
@@ -101,26 +186,29 @@ class EMC2101():
         # as per the data sheet's recommendations.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_BETA_COMPENSATION, 0x07)
 
-        # Set tach limit to a minimum of 400 RPM to ensure fan spin up.
-        # The Noctua NF-A8 fan has a minimum rotational speed of 450 RPM +/- 20%.
-        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_LIMIT_LSB, 0xbc)
-        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_LIMIT_MSB, 0x34)
-
         # Set fan PWM frequency to 25.7 kHz using a 360 kHz base clock.
         # The Noctua NF-A8 fan recommends 25 kHz, acceptable range of 21-28 kHz.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_PWM_FREQ, _PWM_FREQ)
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_PWM_FREQ_DIVIDE, 1)
 
-        # Set fan spin-up to drive the fan at 50% for up to 3.2 seconds until
-        # the tach limit is reached.  Goal is to minimize start-up noise.
-        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SPIN_UP, 0x2f)
-
         # Turn the fan off when the LUT is not used.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SETTING, 0)
 
         # Enable averaging level 2 to guard against electrical noise.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_AVERAGING_FILTER, 0x06)
 
+    def _configure_fan(self):
+        # Set tach limit to the minimum speed at which the fan is considered running,
+        # which also ends spin-up early.
+        tach = _rpm_to_tach(self._tach_limit_rpm)
+        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_LIMIT_LSB, tach & 0xff)
+        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_LIMIT_MSB, tach >> 8)
+
+        # Set fan spin-up to drive the fan at the spin-up level for up to 3.2 seconds
+        # until the tach limit is reached.  Goal is to minimize start-up noise.
+        bits = next(bits for level, bits in _SPIN_UP_LEVELS if level == self._spin_up_level)
+        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SPIN_UP, 0x27 | bits << 3)
+
     def _configure_temperature_limits(self):
         # Set temperature limits for status alerts.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_LIMIT_INTERNAL_HIGH,
@@ -143,6 +231,12 @@ class EMC2101():
         # and then to enable the LUT and make it read-only. Because the fan setting register
         # is initialized to zero, the fan will be turned off if the LUT remains disabled.
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_CONFIG, 0x27)
+        if self._forced_duty_cycle is not None:
+            # Leave the LUT disabled and drive the fan directly from the fan setting register.
+            self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SETTING,
+                    _duty_to_setting(self._forced_duty_cycle))
+            return
+        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SETTING, 0)
         if self._target_temperature > 0:
             # Set hysteresis to a low value to allow for more fine-grained control
             # of the temperature around the target.  Relies on the filtering to reduce
@@ -151,11 +245,8 @@ class EMC2101():
 
             # Prepare a look-up table designed to keep the temperature close to the target.
             self._write_lut_entry(0, 0, 0)
-            self._write_lut_entry(1, self._target_temperature + 1, 20)
-            self._write_lut_entry(2, self._target_temperature + 2, 40)
-            self._write_lut_entry(3, self._target_temperature + 3, 60)
-            self._write_lut_entry(4, self._target_temperature + 4, 80)
-            self._write_lut_entry(5, self._target_temperature + 5, 100)
+            for i, duty_cycle in enumerate(self._lut_duty_cycles):
+                self._write_lut_entry(i + 1, self._target_temperature + i + 1, duty_cycle)
             self._write_lut_padding(6)
             self._write_lut_padding(7)
 
@@ -166,7 +257,7 @@ class EMC2101():
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_LUT_T1 + index * 2,
                 min(max(int(temperature), 0), 127))
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_LUT_S1 + index * 2,
-                math.ceil(duty_cycle * _PWM_FULL_DUTY / 100))
+                _duty_to_setting(duty_cycle))
 
     def _write_lut_padding(self, index):
         self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_LUT_T1 + index * 2, 0x7f)
@@ -175,31 +266,59 @@ class EMC2101():
     def close(self):
         self._bus.close()
 
+    # Measures the fan's response by driving it directly with the LUT and spin-up
+    # disabled.  Steps the duty cycle down from full speed, waiting for the speed
+    # to settle at each step, to find the steady-state speeds and the stall point,
+    # then steps up from standstill to find the duty cycle at which it starts.
+    # Blocks for up to two minutes and restores the configuration when done.
+    # Calls progress, if given, after each measurement, when the telemetry has
+    # just been polled.
+    def characterize(self, steps = _CHARACTERIZATION_STEPS,
+            settle_time = _CHARACTERIZATION_SETTLE_SECONDS, progress = None):
+        points = []
+        start_duty = None
+        try:
+            self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_CONFIG, 0x27)
+            self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SPIN_UP, 0x00)
+            for i in range(steps, -1, -1):
+                duty_cycle = round(100 * i / steps, 1)
+                points.append([duty_cycle, self._measure_fan_speed(duty_cycle, settle_time, progress)])
+            points.reverse()
+
+            self._measure_fan_speed(0, settle_time, progress)
+            for duty_cycle, rpm in points[1:]:
+                if self._measure_fan_speed(duty_cycle, settle_time, progress) > 0:
+                    start_duty = duty_cycle
+                    break
+        finally:
+            self._configure_fan()
+            self._configure_temperature_target()
+
+        running = [d for d, r in points if r > 0]
+        return {
+            "points": points,
+            "stall_duty": min(running) if running else None,
+            "start_duty": start_duty,
+            "max_rpm": max(r for d, r in points)
+        }
+
+    def _measure_fan_speed(self, duty_cycle, settle_time, progress):
+        self._bus.write_byte_data(_CHIP_ADDRESS, _REGISTER_FAN_SETTING, _duty_to_setting(duty_cycle))
+        time.sleep(settle_time)
+        self.poll()
+        if progress:
+            progress()
+        return self._fan_speed
+
     def poll(self):
-        self._poll_internal_temperature()
-        self._poll_external_temperature()
-        self._poll_fan_speed()
-        self._poll_status()
-
-    def _poll_internal_temperature(self):
-        t = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_TEMP_INTERNAL)
-        self._internal_temperature = _toSignedByte(t)
-
-    def _poll_external_temperature(self):
-        # Read MSB first to latch LSB
-        th = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_TEMP_EXTERNAL_MSB)
-        tl = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_TEMP_EXTERNAL_LSB)
-        self._external_temperature = round(_toSignedByte(th) + tl / 256, 1)
-
-    def _poll_fan_speed(self):
-        # Read LSB first to latch MSB (yes, this is the opposite of external temperature)
-        tl = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_READING_LSB)
-        th = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_TACH_READING_MSB)
-        t = th * 256 + tl
+        values = self._telemetry.execute()
+        self._internal_temperature = _toSignedByte(values[0])
+        self._external_temperature = round(_toSignedByte(values[1]) + values[2] / 256, 1)
+        t = values[4] * 256 + values[3]
         self._fan_speed = round(5400000 / t) if t > 0 and t < 65535 else 0
+        self._decode_status(values[5])
 
-    def _poll_status(self):
-        s = self._bus.read_byte_data(_CHIP_ADDRESS, _REGISTER_STATUS)
+    def _decode_status(self, s):
         self._status["internal_temperature_high"] = bool(s & 0x40)
         self._status["external_temperature_low"] = bool(s & 0x08)
         self._status["external_temperature_high"] = bool(s & 0x10)
@@ -226,6 +345,32 @@ class EMC2101():
             self._target_temperature = value
             self._configure_temperature_target()
 
+    # Forced duty cycle: 0 to 100 percent, or None to regulate the target temperature
+    @property
+    def forced_duty_cycle(self):
+        return self._forced_duty_cycle
+
+    @forced_duty_cycle.setter
+    def forced_duty_cycle(self, value):
+        if value is not None:
+            value = min(max(int(value), 0), 100)
+        if value != self._forced_duty_cycle:
+            self._forced_duty_cycle = value
+            self._configure_temperature_target()
+
+    # Fan profile as returned by characterize, or None for the default parameters
+    @property
+    def fan_profile(self):
+        return self._fan_profile
+
+    @fan_profile.setter
+    def fan_profile(self, value):
+        self._fan_profile = value
+        self._tach_limit_rpm, self._spin_up_level, self._lut_duty_cycles = \
+                derive_fan_parameters(value)
+        self._configure_fan()
+        self._configure_temperature_target()
+
     @property
     def fan_speed(self):
         return self._fan_speed
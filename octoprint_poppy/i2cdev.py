@@ -0,0 +1,257 @@
+# coding=utf-8
+from __future__ import absolute_import
+import ctypes
+import errno
+import fcntl
+import os
+import threading
+
+# I2C transport that talks to /dev/i2c-N directly with the I2C_RDWR ioctl and
+# reuses preallocated message structures and buffers, so the operations that
+# the drivers repeat on every poll do not allocate.
+#
+# Besides the subset of the smbus2.SMBus interface used by the drivers, buses
+# can prepare fixed operations once and execute them many times.  The module
+# level prepare_* functions fall back to plain SMBus calls for other buses
+# such as the simulated, recording and replay buses.
+
+# See include/uapi/linux/i2c-dev.h and include/uapi/linux/i2c.h
+_I2C_RDWR = 0x0707
+_I2C_M_RD = 0x0001
+
+_SCRATCH_SIZE = 33
+
+class _I2CMsg(ctypes.Structure):
+    _fields_ = [
+        ("addr", ctypes.c_uint16),
+        ("flags", ctypes.c_uint16),
+        ("len", ctypes.c_uint16),
+        ("buf", ctypes.POINTER(ctypes.c_uint8))]
+
+class _I2CRdwrIoctlData(ctypes.Structure):
+    _fields_ = [
+        ("msgs", ctypes.POINTER(_I2CMsg)),
+        ("nmsgs", ctypes.c_uint32)]
+
+def _pointer(buffer, offset = 0):
+    return ctypes.cast(ctypes.byref(buffer, offset), ctypes.POINTER(ctypes.c_uint8))
+
+class _Transaction():
+    # A fixed set of messages executed with a single ioctl.
+    def __init__(self, count):
+        self._messages = (_I2CMsg * count)()
+        self._request = _I2CRdwrIoctlData(self._messages, count)
+        self._request_address = ctypes.addressof(self._request)
+
+    def _set(self, index, address, flags, buffer, offset, length):
+        message = self._messages[index]
+        message.addr = address
+        message.flags = flags
+        message.len = length
+        message.buf = _pointer(buffer, offset)
+
+class I2CDevBus():
+    def __init__(self, bus_number):
+        self._fd = os.open("/dev/i2c-%d" % bus_number, os.O_RDWR)
+        self._lock = threading.Lock()
+
+        # Scratch transaction for register reads and writes: the first byte of
+        # the buffer holds the register, the rest holds the data.
+        self._scratch = (ctypes.c_uint8 * _SCRATCH_SIZE)()
+        self._scratch_view = memoryview(self._scratch).cast("B")
+        self._write_read = _Transaction(2)
+        self._write_read._set(0, 0, 0, self._scratch, 0, 1)
+        self._write_read._set(1, 0, _I2C_M_RD, self._scratch, 1, 1)
+        self._write = _Transaction(1)
+        self._write._set(0, 0, 0, self._scratch, 0, 1)
+
+    def _execute(self, transaction):
+        fcntl.ioctl(self._fd, _I2C_RDWR, transaction._request_address)
+
+    def _read_scratch(self, address, register, length):
+        messages = self._write_read._messages
+        messages[0].addr = address
+        messages[1].addr = address
+        messages[1].len = length
+        self._scratch[0] = register
+        self._execute(self._write_read)
+
+    def _write_scratch(self, address, length):
+        message = self._write._messages[0]
+        message.addr = address
+        message.len = length
+        self._execute(self._write)
+
+    def read_byte_data(self, address, register):
+        with self._lock:
+            self._read_scratch(address, register, 1)
+            return self._scratch[1]
+
+    def write_byte_data(self, address, register, value):
+        with self._lock:
+            self._scratch[0] = register
+            self._scratch[1] = value
+            self._write_scratch(address, 2)
+
+    def read_i2c_block_data(self, address, register, length):
+        if length > _SCRATCH_SIZE - 1:
+            raise ValueError("Block too long")
+        with self._lock:
+            self._read_scratch(address, register, length)
+            return self._scratch_view[1:1 + length].tolist()
+
+    def write_i2c_block_data(self, address, register, data):
+        if len(data) > _SCRATCH_SIZE - 1:
+            raise ValueError("Block too long")
+        with self._lock:
+            self._scratch[0] = register
+            self._scratch_view[1:1 + len(data)] = bytes(data)
+            self._write_scratch(address, 1 + len(data))
+
+    def i2c_rdwr(self, *messages):
+        # Accepts smbus2.i2c_msg objects, which share the kernel's layout.
+        transaction = _Transaction(len(messages))
+        for index, message in enumerate(messages):
+            target = transaction._messages[index]
+            target.addr = message.addr
+            target.flags = message.flags
+            target.len = message.len
+            target.buf = ctypes.cast(message.buf, ctypes.POINTER(ctypes.c_uint8))
+        with self._lock:
+            self._execute(transaction)
+
+    def prepare_reads(self, address, registers):
+        return _PreparedReads(self, address, registers)
+
+    def prepare_block_read(self, address, register, length):
+        return _PreparedBlockRead(self, address, register, length)
+
+    def prepare_block_write(self, address, register, length):
+        return _PreparedBlockWrite(self, address, register, length)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _PreparedReads(_Transaction):
+    # Reads single registers in the given order.  Adapters that support it do
+    # this within one combined transaction.  Others, such as the Raspberry Pi's,
+    # only accept a read as the last message of a transaction and reject the
+    # combined one with EOPNOTSUPP, after which each register is read with its
+    # own write and read pair.
+    def __init__(self, bus, address, registers):
+        _Transaction.__init__(self, len(registers) * 2)
+        self._bus = bus
+        self._registers = (ctypes.c_uint8 * len(registers))(*registers)
+        self._values = (ctypes.c_uint8 * len(registers))()
+        self.values = memoryview(self._values).cast("B")
+        self._pairs = []
+        for index in range(len(registers)):
+            self._set(index * 2, address, 0, self._registers, index, 1)
+            self._set(index * 2 + 1, address, _I2C_M_RD, self._values, index, 1)
+            pair = _Transaction(2)
+            pair._set(0, address, 0, self._registers, index, 1)
+            pair._set(1, address, _I2C_M_RD, self._values, index, 1)
+            self._pairs.append(pair)
+        self._combined = len(registers) > 1
+
+    # Returns a view of the values, valid until the next call.
+    def execute(self):
+        with self._bus._lock:
+            if self._combined:
+                try:
+                    self._bus._execute(self)
+                    return self.values
+                except OSError as e:
+                    if e.errno != errno.EOPNOTSUPP:
+                        raise
+                    self._combined = False
+            for pair in self._pairs:
+                self._bus._execute(pair)
+        return self.values
+
+class _PreparedBlockRead(_Transaction):
+    def __init__(self, bus, address, register, length):
+        _Transaction.__init__(self, 2)
+        self._bus = bus
+        self._register = (ctypes.c_uint8 * 1)(register)
+        self._values = (ctypes.c_uint8 * length)()
+        self.values = memoryview(self._values).cast("B")
+        self._set(0, address, 0, self._register, 0, 1)
+        self._set(1, address, _I2C_M_RD, self._values, 0, length)
+
+    def execute(self):
+        with self._bus._lock:
+            self._bus._execute(self)
+        return self.values
+
+class _PreparedBlockWrite(_Transaction):
+    # Fill in data, then execute.
+    def __init__(self, bus, address, register, length):
+        _Transaction.__init__(self, 1)
+        self._bus = bus
+        self._buffer = (ctypes.c_uint8 * (length + 1))(register)
+        self.data = memoryview(self._buffer).cast("B")[1:]
+        self._set(0, address, 0, self._buffer, 0, length + 1)
+
+    def execute(self):
+        with self._bus._lock:
+            self._bus._execute(self)
+
+class _GenericReads():
+    def __init__(self, bus, address, registers):
+        self._bus = bus
+        self._address = address
+        self._registers = list(registers)
+        self.values = bytearray(len(self._registers))
+
+    def execute(self):
+        for index, register in enumerate(self._registers):
+            self.values[index] = self._bus.read_byte_data(self._address, register)
+        return self.values
+
+class _GenericBlockRead():
+    def __init__(self, bus, address, register, length):
+        self._bus = bus
+        self._address = address
+        self._register = register
+        self.values = bytearray(length)
+
+    def execute(self):
+        self.values[:] = bytes(self._bus.read_i2c_block_data(self._address, self._register, len(self.values)))
+        return self.values
+
+class _GenericBlockWrite():
+    def __init__(self, bus, address, register, length):
+        self._bus = bus
+        self._address = address
+        self._register = register
+        self.data = bytearray(length)
+
+    def execute(self):
+        self._bus.write_i2c_block_data(self._address, self._register, list(self.data))
+
+# Prepare reads of single registers, executed in order.
+def prepare_reads(bus, address, registers):
+    if hasattr(bus, "prepare_reads"):
+        return bus.prepare_reads(address, registers)
+    return _GenericReads(bus, address, registers)
+
+# Prepare a read of consecutive registers.
+def prepare_block_read(bus, address, register, length):
+    if hasattr(bus, "prepare_block_read"):
+        return bus.prepare_block_read(address, register, length)
+    return _GenericBlockRead(bus, address, register, length)
+
+# Prepare a write of consecutive registers.
+def prepare_block_write(bus, address, register, length):
+    if hasattr(bus, "prepare_block_write"):
+        return bus.prepare_block_write(address, register, length)
+    return _GenericBlockWrite(bus, address, register, length)
@@ -0,0 +1,214 @@
+# coding=utf-8
+from __future__ import absolute_import
+import collections
+import ctypes
+import struct
+import threading
+import time
+
+# Records every I2C transaction issued through a bus into a compact binary trace
+# and replays traces back to the drivers, for reproducing fault behavior and
+# timing seen on real boards.
+#
+# File layout: the magic string followed by one record per transaction.  Each
+# record is a fixed header (start time and duration in seconds relative to the
+# start of the recording, operation, address, register, errno or 0, payload
+# length) followed by the payload: the bytes written for writes, the bytes read
+# for reads, or for combined transactions a (flags, length, data) entry per message.
+_MAGIC = b"POPPYI2C\x01"
+_RECORD_HEADER = struct.Struct("<dfBBBBH")
+_MESSAGE_HEADER = struct.Struct("<BH")
+
+_OP_READ_BYTE = 1
+_OP_WRITE_BYTE = 2
+_OP_READ_BLOCK = 3
+_OP_WRITE_BLOCK = 4
+_OP_RDWR = 5
+
+_WRITE_OPS = (_OP_WRITE_BYTE, _OP_WRITE_BLOCK)
+
+_I2C_M_RD = 0x0001
+
+_FLUSH_INTERVAL_SECONDS = 5
+
+class ReplayMismatchError(Exception):
+    pass
+
+def _message_data(message):
+    return bytes(bytearray(message)[:message.len])
+
+def _set_message_data(message, data):
+    if isinstance(message.buf, bytearray):
+        message.buf[0:len(data)] = data
+    else:
+        ctypes.memmove(message.buf, data, len(data))
+
+class TraceRecorder():
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(_MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_flush = self._start
+
+    # Wrap a bus so that its transactions are recorded; several buses may share a recorder.
+    def wrap(self, bus):
+        return RecordingBus(self, bus)
+
+    def _record(self, start, end, op, address, register, error, payload):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_RECORD_HEADER.pack(start - self._start, end - start,
+                    op, address, register, error, len(payload)))
+            self._file.write(payload)
+            if end - self._last_flush >= _FLUSH_INTERVAL_SECONDS:
+                self._file.flush()
+                self._last_flush = end
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class RecordingBus():
+    def __init__(self, recorder, bus):
+        self._recorder = recorder
+        self._bus = bus
+
+    def _call(self, op, address, register, fn, encode):
+        start = time.monotonic()
+        try:
+            result = fn()
+        except OSError as e:
+            self._recorder._record(start, time.monotonic(), op, address, register,
+                    (e.errno or 0) & 0xff or 0xff, b"")
+            raise
+        self._recorder._record(start, time.monotonic(), op, address, register, 0, encode(result))
+        return result
+
+    def read_byte_data(self, address, register):
+        return self._call(_OP_READ_BYTE, address, register,
+                lambda: self._bus.read_byte_data(address, register),
+                lambda result: bytes([result]))
+
+    def write_byte_data(self, address, register, value):
+        return self._call(_OP_WRITE_BYTE, address, register,
+                lambda: self._bus.write_byte_data(address, register, value),
+                lambda result: bytes([value]))
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._call(_OP_READ_BLOCK, address, register,
+                lambda: self._bus.read_i2c_block_data(address, register, length),
+                bytes)
+
+    def write_i2c_block_data(self, address, register, data):
+        return self._call(_OP_WRITE_BLOCK, address, register,
+                lambda: self._bus.write_i2c_block_data(address, register, data),
+                lambda result: bytes(data))
+
+    def i2c_rdwr(self, *messages):
+        def encode(result):
+            return b"".join(_MESSAGE_HEADER.pack(message.flags & 0xff, message.len)
+                    + _message_data(message) for message in messages)
+        return self._call(_OP_RDWR, messages[0].addr if messages else 0, 0,
+                lambda: self._bus.i2c_rdwr(*messages), encode)
+
+    def close(self):
+        self._bus.close()
+
+class TraceReplay():
+    # Loads a trace and hands out replay buses that answer the drivers from it.
+    # Records are queued per chip address so that drivers running on different
+    # threads see their own transactions in order.  speed scales the recorded
+    # timing, 0 replays as fast as possible.  Unless strict, recorded writes that
+    # the drivers do not repeat are skipped and writes missing from the trace are
+    # accepted, so that replays stay in step when the control logic changes.
+    def __init__(self, path, speed = 1.0, strict = True):
+        self.speed = speed
+        self.strict = strict
+        self._queues = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._start = None
+        self.records = 0
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError("Not an I2C trace file")
+        offset = len(_MAGIC)
+        while offset < len(data):
+            start, duration, op, address, register, error, length = \
+                    _RECORD_HEADER.unpack_from(data, offset)
+            offset += _RECORD_HEADER.size
+            payload = data[offset:offset + length]
+            offset += length
+            self._queues[address].append((start, duration, op, register, error, payload))
+            self.records += 1
+
+    def bus(self):
+        return ReplayBus(self)
+
+    @property
+    def remaining(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _next(self, op, address, register):
+        with self._lock:
+            if self._start is None:
+                self._start = time.monotonic()
+            queue = self._queues.get(address)
+            while True:
+                if not queue:
+                    raise EOFError("I2C trace exhausted for address 0x%02x" % address)
+                start, duration, recorded_op, recorded_register, error, payload = queue[0]
+                if recorded_op == op and recorded_register == register:
+                    queue.popleft()
+                    break
+                if not self.strict and recorded_op in _WRITE_OPS:
+                    queue.popleft()
+                    continue
+                if not self.strict and op in _WRITE_OPS:
+                    return b""
+                raise ReplayMismatchError("Expected op %s register 0x%02x at address 0x%02x, "
+                        "trace has op %s register 0x%02x" % (op, register, address,
+                        recorded_op, recorded_register))
+        if self.speed > 0:
+            delay = self._start + start / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if duration > 0:
+                time.sleep(duration / self.speed)
+        if error:
+            raise OSError(error, "Replayed I2C error")
+        return payload
+
+class ReplayBus():
+    def __init__(self, replay):
+        self._replay = replay
+
+    def read_byte_data(self, address, register):
+        return self._replay._next(_OP_READ_BYTE, address, register)[0]
+
+    def write_byte_data(self, address, register, value):
+        self._replay._next(_OP_WRITE_BYTE, address, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return list(self._replay._next(_OP_READ_BLOCK, address, register)[:length])
+
+    def write_i2c_block_data(self, address, register, data):
+        self._replay._next(_OP_WRITE_BLOCK, address, register)
+
+    def i2c_rdwr(self, *messages):
+        payload = self._replay._next(_OP_RDWR, messages[0].addr if messages else 0, 0)
+        offset = 0
+        for message in messages:
+            flags, length = _MESSAGE_HEADER.unpack_from(payload, offset)
+            offset += _MESSAGE_HEADER.size
+            if message.flags & _I2C_M_RD:
+                _set_message_data(message, payload[offset:offset + min(length, message.len)])
+            offset += length
+
+    def close(self):
+        pass
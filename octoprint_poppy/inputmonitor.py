@@ -0,0 +1,154 @@
+# coding=utf-8
+from __future__ import absolute_import
+import fcntl
+import os
+import select
+import struct
+import threading
+
+# Linux GPIO character device ABI (v1), see include/uapi/linux/gpio.h
+_GPIO_GET_LINEEVENT_IOCTL = 0xc030b404
+_GPIOEVENT_REQUEST_FORMAT = "III32si"
+_GPIOEVENT_REQUEST_FD_OFFSET = 44
+_GPIOEVENT_DATA_SIZE = 16
+_GPIOHANDLE_REQUEST_INPUT = 1 << 0
+_GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+
+# Inputs are read again after this long without an edge in case one was missed
+# while the INT line was already asserted.
+_RESYNC_INTERVAL_SECONDS = 5
+
+_DEFAULT_POLL_INTERVAL_SECONDS = 0.05
+
+# Edge sources report when the AW9523 asserts its INT line.  wait() returns True
+# when the inputs should be read and False when the timeout expired first.
+# interrupt() wakes up a pending wait() so that the monitor can stop.
+
+class GpioEdgeSource():
+    # Waits for falling edges on the INT line through the GPIO character device.
+    def __init__(self, chip_path, line, consumer = "poppy"):
+        chip_fd = os.open(chip_path, os.O_RDONLY)
+        try:
+            request = bytearray(struct.pack(_GPIOEVENT_REQUEST_FORMAT, line,
+                    _GPIOHANDLE_REQUEST_INPUT, _GPIOEVENT_REQUEST_FALLING_EDGE,
+                    consumer.encode("ascii"), 0))
+            fcntl.ioctl(chip_fd, _GPIO_GET_LINEEVENT_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+        self._fd = struct.unpack_from("i", request, _GPIOEVENT_REQUEST_FD_OFFSET)[0]
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN | select.POLLPRI)
+        self._poll.register(self._wakeup_read_fd, select.POLLIN)
+
+    def wait(self, timeout):
+        events = self._poll.poll(timeout * 1000)
+        if not events or any(fd == self._wakeup_read_fd for fd, _ in events):
+            return False
+        # Drain the queued events since a single read covers all of them.
+        while any(fd == self._fd for fd, _ in self._poll.poll(0)):
+            os.read(self._fd, _GPIOEVENT_DATA_SIZE)
+        return True
+
+    def interrupt(self):
+        os.write(self._wakeup_write_fd, b"\0")
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            os.close(self._wakeup_read_fd)
+            os.close(self._wakeup_write_fd)
+            self._fd = None
+
+class LocalEdgeSource():
+    # Edge source that is triggered from software, for tests and simulations.
+    def __init__(self):
+        self._event = threading.Event()
+
+    def trigger(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        triggered = self._event.wait(timeout)
+        self._event.clear()
+        return triggered
+
+    def interrupt(self):
+        self._event.set()
+
+    def close(self):
+        pass
+
+class PollingEdgeSource():
+    # Fallback for boards where the INT line is not connected: read at a fixed rate.
+    def __init__(self, interval = _DEFAULT_POLL_INTERVAL_SECONDS):
+        self._interval = interval
+        self._interrupted = threading.Event()
+
+    def wait(self, timeout):
+        return not self._interrupted.wait(min(self._interval, timeout))
+
+    def interrupt(self):
+        self._interrupted.set()
+
+    def close(self):
+        pass
+
+class InputMonitor():
+    # Watches AW9523 input pins and reports changes to callbacks of the form
+    # callback(pin, state).  The expander raises its INT line when an input with
+    # its interrupt enabled changes; the monitor then reads both ports in one
+    # transaction, which also clears the interrupt, and dispatches the changes.
+    def __init__(self, io, edge_source):
+        self._io = io
+        self._edge_source = edge_source
+        self._callbacks = {}
+        self._mask = 0
+        self._inputs = 0
+        self._thread = None
+        self._stopping = False
+
+    def add_pin(self, pin, callback):
+        input_pin = self._io.input_pin(pin)
+        input_pin.interrupt_enabled = True
+        self._callbacks.setdefault(pin, []).append(callback)
+        self._mask |= 1 << pin
+
+    # Last known pin state, without bus access
+    def state(self, pin):
+        return bool(self._inputs & (1 << pin))
+
+    def start(self):
+        self._inputs = self._io.read_inputs()
+        self._stopping = False
+        self._thread = threading.Thread(target = self._run, name = "poppy-inputs")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stopping = True
+            self._edge_source.interrupt()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping:
+            self._edge_source.wait(_RESYNC_INTERVAL_SECONDS)
+            if self._stopping:
+                break
+            self.check()
+
+    # Read the inputs and dispatch any changes, returns the changed bits.
+    def check(self):
+        inputs = self._io.read_inputs()
+        changed = (inputs ^ self._inputs) & self._mask
+        self._inputs = inputs
+        pin = 0
+        while changed >> pin:
+            if changed & (1 << pin):
+                state = bool(inputs & (1 << pin))
+                for callback in self._callbacks[pin]:
+                    callback(pin, state)
+            pin += 1
+        return changed
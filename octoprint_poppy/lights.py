@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Light backends drive chamber light zones, each zone mapped to one or more
+# channels of a chip.  A backend keeps a shadow of the output registers of the
+# channels it owns and writes changes as auto-increment bursts over those
+# registers, so that updating any number of zones costs one transaction per chip
+# when the channels are contiguous.  Bursts are only split where a register in
+# between belongs to something else, such as the power supply relay, or where
+# they would exceed the SMBus block size.  Levels are given in percent and
+# looked up in tables precomputed for each backend.
+
+_MAX_BURST_BYTES = 32
+
+def _pca9685_encoding(level):
+    # Same timings as PCA9685.Pin.duty_cycle.
+    duty_cycle = int(level * 4096 / 100)
+    if duty_cycle >= 4096:
+        on_time, off_time = 4096, 0
+    elif duty_cycle <= 0:
+        on_time, off_time = 0, 4096
+    else:
+        on_time, off_time = 0, duty_cycle
+    return bytes([on_time & 0xff, on_time >> 8, off_time & 0xff, off_time >> 8])
+
+def _aw9523_encoding(level):
+    return bytes([round(level * 255 / 100)])
+
+_PCA9685_LEVELS = [_pca9685_encoding(level) for level in range(101)]
+_AW9523_LEVELS = [_aw9523_encoding(level) for level in range(101)]
+
+# Write an encoded level through a pin object, for chips without block writes.
+def _write_pca9685_pin(pin, encoded):
+    on_time = encoded[0] | encoded[1] << 8
+    off_time = encoded[2] | encoded[3] << 8
+    pin.duty_cycle = 4096 if on_time == 4096 else off_time % 4096
+
+def _write_aw9523_pin(pin, encoded):
+    pin.level = encoded[0]
+
+class _Burst():
+    def __init__(self, register):
+        self.register = register
+        self.length = 0
+        self.write = None
+        self.dirty = True
+
+class _LightBackend():
+    # zones maps zone names to lists of channels; pins maps channels to pin
+    # objects exposing the first output register of the channel.  When
+    # bridge_gaps is set, bursts also cover registers of unused channels in
+    # between, which then stay at level 0.  write_pin writes an encoded level
+    # to a pin when the chip has no block writes.
+    def __init__(self, chip, zones, pins, width, levels, bridge_gaps, write_pin):
+        self._zones = dict((name, list(channels)) for name, channels in zones.items())
+        self._pins = pins
+        self._width = width
+        self._levels = levels
+        self._write_pin = write_pin
+        self._zone_levels = {}
+
+        # Group the registers into bursts.  Chips without block writes, such as
+        # the hardware daemon's proxies, are written pin by pin instead.
+        self._bursts = []
+        self._slots = {}
+        if not hasattr(chip, "prepare_register_write"):
+            return
+        for channel in sorted(pins, key = lambda channel: pins[channel].register):
+            register = pins[channel].register
+            burst = self._bursts[-1] if self._bursts else None
+            if (burst is None or register - burst.register + width > _MAX_BURST_BYTES
+                    or (burst.register + burst.length != register and not bridge_gaps)):
+                burst = _Burst(register)
+                self._bursts.append(burst)
+            self._slots[channel] = (burst, register - burst.register)
+            burst.length = register - burst.register + width
+        for burst in self._bursts:
+            burst.write = chip.prepare_register_write(burst.register, burst.length)
+            burst.write.data[:] = levels[0] * (burst.length // width)
+
+    @property
+    def zones(self):
+        return list(self._zones)
+
+    # Set the levels of several zones in percent and write the registers that changed.
+    def set_levels(self, levels):
+        for name, level in levels.items():
+            encoded = self._levels[min(max(int(round(level)), 0), 100)]
+            if not self._bursts:
+                if self._zone_levels.get(name) != encoded:
+                    for channel in self._zones[name]:
+                        self._write_pin(self._pins[channel], encoded)
+            else:
+                for channel in self._zones[name]:
+                    burst, offset = self._slots[channel]
+                    if burst.write.data[offset:offset + self._width] != encoded:
+                        burst.write.data[offset:offset + self._width] = encoded
+                        burst.dirty = True
+            self._zone_levels[name] = encoded
+        for burst in self._bursts:
+            if burst.dirty:
+                burst.write.execute()
+                burst.dirty = False
+
+    def close(self):
+        self.set_levels(dict((name, 0) for name in self._zones))
+
+def _claim_channels(zones):
+    channels = []
+    for name, zone_channels in zones.items():
+        for channel in zone_channels:
+            if channel in channels:
+                raise AttributeError("Light channel %s is used by more than one zone" % channel)
+            channels.append(channel)
+    return channels
+
+class PCA9685LightBackend(_LightBackend):
+    # Drives LEDs with PWM from the PCA9685 (or the hardware daemon's proxy).
+    def __init__(self, io, zones):
+        pins = dict((channel, io.pin(channel)) for channel in _claim_channels(zones))
+        # Unused channels may be driven by something else, such as the relay.
+        _LightBackend.__init__(self, io, zones, pins, 4, _PCA9685_LEVELS, False, _write_pca9685_pin)
+
+class AW9523LightBackend(_LightBackend):
+    # Drives LEDs with the AW9523's constant-current outputs.
+    def __init__(self, io, zones):
+        pins = dict((channel, io.led_pin(channel)) for channel in _claim_channels(zones))
+        # The current control registers only take effect for pins in LED mode,
+        # so a single burst can span all of them.
+        _LightBackend.__init__(self, io, zones, pins, 1, _AW9523_LEVELS, True, _write_aw9523_pin)
@@ -0,0 +1,332 @@
+# coding=utf-8
+from __future__ import absolute_import
+import collections
+import json
+import select
+import socket
+import struct
+import threading
+import time
+
+# Exports chamber telemetry over MQTT for monitoring systems.
+#
+# The plugin offers every state change to the exporter, which only keeps the
+# latest one, so offering never blocks or touches the network.  The exporter's
+# thread samples the latest state once per interval, drops it unless a value
+# moved past its deadband (or the heartbeat is due), and queues the snapshot.
+# Queued snapshots are published over a persistent connection.  While the broker
+# is unreachable or not keeping up, snapshots stay queued up to a bound, beyond
+# which the oldest are dropped and counted, and the exporter reconnects with
+# exponential backoff.
+#
+# Only the parts of MQTT 3.1.1 needed to publish at QoS 0 are implemented, with
+# a retained last will that marks the printer offline.
+
+_PROTOCOL_LEVEL = 4
+
+_CONNECT = 0x10
+_CONNACK = 0x20
+_PUBLISH = 0x30
+_PINGREQ = 0xc0
+_PINGRESP = 0xd0
+_DISCONNECT = 0xe0
+
+_RETAIN = 0x01
+
+_CONNECT_FLAG_CLEAN_SESSION = 0x02
+_CONNECT_FLAG_WILL = 0x04
+_CONNECT_FLAG_WILL_RETAIN = 0x20
+_CONNECT_FLAG_PASSWORD = 0x40
+_CONNECT_FLAG_USERNAME = 0x80
+
+_KEEPALIVE_SECONDS = 60
+_SOCKET_TIMEOUT_SECONDS = 5
+
+_DEFAULT_INTERVAL_SECONDS = 5
+_HEARTBEAT_SECONDS = 60
+_BUFFER_LENGTH = 720 # an hour of snapshots at the default interval
+_RECONNECT_DELAY_SECONDS = 1
+_MAX_RECONNECT_DELAY_SECONDS = 60
+
+# Minimum change that triggers a snapshot for numeric fields; any change of the
+# other fields does.
+_DEADBANDS = {
+    "chamber_temperature": 0.5,
+    "chamber_fan_speed": 100
+}
+
+_EXPORTED_FIELDS = [
+    "chamber_temperature",
+    "chamber_target_temperature",
+    "chamber_fan_speed",
+    "fan_status",
+    "chamber_light_mode",
+    "psu"
+]
+
+class MqttError(Exception):
+    pass
+
+def _encode_string(value):
+    data = value.encode("utf-8") if isinstance(value, str) else bytes(value)
+    return struct.pack(">H", len(data)) + data
+
+def _encode_packet(packet_type, body):
+    # Fixed header with the remaining length as a variable-length integer.
+    header = bytearray([packet_type])
+    length = len(body)
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+def _read_packet(sock):
+    # Returns the packet type and body; raises on a closed connection.
+    def read(count):
+        data = b""
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise MqttError("Connection closed by the broker")
+            data += chunk
+        return data
+    packet_type = read(1)[0]
+    length = 0
+    shift = 0
+    while True:
+        byte = read(1)[0]
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+        if shift > 21:
+            raise MqttError("Malformed remaining length")
+    return packet_type, read(length) if length else b""
+
+class MqttClient():
+    # A connection to an MQTT broker that publishes at QoS 0.  Not thread-safe.
+    def __init__(self, host, port, client_id, username = None, password = None,
+            will_topic = None, will_message = None, keepalive = _KEEPALIVE_SECONDS,
+            socket_timeout = _SOCKET_TIMEOUT_SECONDS):
+        self._socket = socket.create_connection((host, port), socket_timeout)
+        self._keepalive = keepalive
+        try:
+            flags = _CONNECT_FLAG_CLEAN_SESSION
+            payload = _encode_string(client_id)
+            if will_topic is not None:
+                flags |= _CONNECT_FLAG_WILL | _CONNECT_FLAG_WILL_RETAIN
+                payload += _encode_string(will_topic) + _encode_string(will_message or b"")
+            if username is not None:
+                flags |= _CONNECT_FLAG_USERNAME
+                payload += _encode_string(username)
+                if password is not None:
+                    flags |= _CONNECT_FLAG_PASSWORD
+                    payload += _encode_string(password)
+            self._send(_encode_packet(_CONNECT, _encode_string("MQTT")
+                    + struct.pack(">BBH", _PROTOCOL_LEVEL, flags, keepalive) + payload))
+            packet_type, body = _read_packet(self._socket)
+            if packet_type & 0xf0 != _CONNACK or len(body) != 2:
+                raise MqttError("Expected CONNACK")
+            if body[1] != 0:
+                raise MqttError("Connection refused with return code %s" % body[1])
+        except Exception:
+            self._socket.close()
+            raise
+        self._last_sent = time.monotonic()
+        self._last_received = self._last_sent
+        self._ping_outstanding = False
+
+    def _send(self, data):
+        # Times out if the broker stops draining the socket, which the exporter
+        # treats as a lost connection.
+        self._socket.sendall(data)
+        self._last_sent = time.monotonic()
+
+    def publish(self, topic, payload, retain = False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._send(_encode_packet(_PUBLISH | (_RETAIN if retain else 0),
+                _encode_string(topic) + payload))
+
+    # Handles keepalive; call regularly, at least every keepalive / 2 seconds.
+    def service(self):
+        now = time.monotonic()
+        while select.select([self._socket], [], [], 0)[0]:
+            packet_type, body = _read_packet(self._socket)
+            self._last_received = now
+            if packet_type & 0xf0 == _PINGRESP:
+                self._ping_outstanding = False
+        if self._ping_outstanding and now - self._last_received > self._keepalive:
+            raise MqttError("Broker stopped responding")
+        if not self._ping_outstanding and now - self._last_sent >= self._keepalive / 2:
+            self._send(_encode_packet(_PINGREQ, b""))
+            self._ping_outstanding = True
+
+    def disconnect(self):
+        # A clean disconnect, after which the broker discards the last will.
+        try:
+            self._send(_encode_packet(_DISCONNECT, b""))
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        self._socket.close()
+
+class TelemetryExporter():
+    def __init__(self, host, port, client_id, topic_prefix, logger,
+            username = None, password = None, interval = _DEFAULT_INTERVAL_SECONDS,
+            buffer_length = _BUFFER_LENGTH, socket_timeout = _SOCKET_TIMEOUT_SECONDS):
+        self._host = host
+        self._port = port
+        self._client_id = client_id
+        self._username = username
+        self._password = password
+        self._telemetry_topic = topic_prefix + "/telemetry"
+        self._status_topic = topic_prefix + "/status"
+        self._logger = logger
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pending = None
+        self._last_queued = None
+        self._last_queued_time = 0
+        self._queue = collections.deque()
+        self._buffer_length = buffer_length
+        self._socket_timeout = socket_timeout
+        self._client = None
+        self.published = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "poppy-mqtt")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+    # Offer the latest plugin state; cheap and non-blocking.
+    def offer(self, state):
+        with self._lock:
+            self._pending = state
+
+    # Publish what is pending and queued without waiting for the next interval.
+    def flush(self):
+        self._wakeup.set()
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def _run(self):
+        next_sample = time.monotonic()
+        next_connect = next_sample
+        reconnect_delay = _RECONNECT_DELAY_SECONDS
+        while True:
+            now = time.monotonic()
+            timeout = next_sample - now
+            if self._client is None:
+                timeout = min(timeout, next_connect - now)
+            else:
+                timeout = min(timeout, _KEEPALIVE_SECONDS / 4)
+            self._wakeup.wait(max(timeout, 0))
+            flush = self._wakeup.is_set()
+            self._wakeup.clear()
+            if self._stopping:
+                break
+
+            now = time.monotonic()
+            if flush or now >= next_sample:
+                self._sample(now)
+                next_sample = now + self._interval
+
+            if self._client is None and (flush or now >= next_connect):
+                if self._connect():
+                    reconnect_delay = _RECONNECT_DELAY_SECONDS
+                else:
+                    next_connect = now + reconnect_delay
+                    reconnect_delay = min(reconnect_delay * 2, _MAX_RECONNECT_DELAY_SECONDS)
+            if self._client is not None:
+                try:
+                    self._drain()
+                    self._client.service()
+                except (OSError, MqttError) as e:
+                    self._logger.warning("Lost the MQTT connection: %s", e)
+                    self._client.close()
+                    self._client = None
+                    next_connect = time.monotonic() + reconnect_delay
+
+        if self._client is not None:
+            try:
+                self._drain()
+                self._client.publish(self._status_topic, "offline", retain = True)
+            except (OSError, MqttError):
+                pass
+            self._client.disconnect()
+            self._client = None
+
+    def _connect(self):
+        try:
+            self._client = MqttClient(self._host, self._port, self._client_id,
+                    self._username, self._password, self._status_topic, b"offline",
+                    socket_timeout = self._socket_timeout)
+            self._client.publish(self._status_topic, "online", retain = True)
+        except (OSError, MqttError) as e:
+            self._logger.warning("Failed to connect to the MQTT broker at %s:%s: %s",
+                    self._host, self._port, e)
+            if self._client:
+                self._client.close()
+                self._client = None
+            return False
+        self._logger.info("Connected to the MQTT broker at %s:%s", self._host, self._port)
+        return True
+
+    def _sample(self, now):
+        with self._lock:
+            state = self._pending
+        if state is None:
+            return
+        snapshot = dict((name, state.get(name)) for name in _EXPORTED_FIELDS)
+        if (self._last_queued is not None and now - self._last_queued_time < _HEARTBEAT_SECONDS
+                and not self._changed(snapshot)):
+            return
+        self._last_queued = snapshot
+        self._last_queued_time = now
+        snapshot = dict(snapshot)
+        snapshot["time"] = round(time.time(), 3)
+        if len(self._queue) >= self._buffer_length:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(json.dumps(snapshot, sort_keys = True))
+
+    def _changed(self, snapshot):
+        for name, value in snapshot.items():
+            last = self._last_queued.get(name)
+            deadband = _DEADBANDS.get(name)
+            if deadband is not None and value is not None and last is not None:
+                if abs(value - last) >= deadband:
+                    return True
+            elif value != last:
+                return True
+        return False
+
+    def _drain(self):
+        # Leave a snapshot queued until it has been handed to the socket.
+        while self._queue:
+            self._client.publish(self._telemetry_topic, self._queue[0])
+            self._queue.popleft()
+            self.published += 1
@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import
+import socket
+import struct
+import threading
+try:
+    from .mqtt import _encode_packet, _read_packet, MqttError
+except ImportError:
+    from mqtt import _encode_packet, _read_packet, MqttError
+
+# In-process stand-in for an MQTT broker, for exercising the telemetry exporter
+# without a real broker.  Accepts any client, answers CONNECT and PINGREQ,
+# records every published message (including last wills published when a client
+# drops), and can be taken offline or made to stop reading to simulate outages
+# and slow brokers.  As with real brokers, a client connecting with the ID of a
+# connected client takes over its session: the previous connection is dropped
+# and its last will published before the new one is accepted.
+
+_CONNECT = 0x10
+_CONNACK = 0x20
+_PUBLISH = 0x30
+_PINGREQ = 0xc0
+_PINGRESP = 0xd0
+_DISCONNECT = 0xe0
+
+_CONNACK_ACCEPTED = 0
+_CONNACK_SERVER_UNAVAILABLE = 3
+
+def _decode_string(data, offset):
+    length = struct.unpack_from(">H", data, offset)[0]
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+class _Session():
+    def __init__(self, client, client_id, will):
+        self.client = client
+        self.client_id = client_id
+        self.will = will
+        self.ended = False
+
+class LocalBroker():
+    def __init__(self, port = 0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", port))
+        self._server.listen(4)
+        self.port = self._server.getsockname()[1]
+        self._lock = threading.Condition()
+        self._sessions = {}
+        self._stopping = False
+        self.online = True
+        self.reading = threading.Event()
+        self.reading.set()
+        self.connections = 0
+        self.messages = [] # (topic, payload, retain)
+        self.retained = {}
+        self._thread = threading.Thread(target = self._accept, name = "mqtt-broker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stopping:
+            try:
+                client, address = self._server.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target = self._serve, args = (client,), name = "mqtt-broker-client")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        session = None
+        try:
+            packet_type, body = _read_packet(client)
+            if packet_type & 0xf0 != _CONNECT:
+                return
+            if not self.online:
+                client.sendall(_encode_packet(_CONNACK, bytes([0, _CONNACK_SERVER_UNAVAILABLE])))
+                return
+            protocol, offset = _decode_string(body, 0)
+            level, flags, keepalive = struct.unpack_from(">BBH", body, offset)
+            client_id, offset = _decode_string(body, offset + 4)
+            will = None
+            if flags & 0x04:
+                will_topic, offset = _decode_string(body, offset)
+                will_message, offset = _decode_string(body, offset)
+                will = (will_topic.decode("utf-8"), will_message, bool(flags & 0x20))
+            session = _Session(client, client_id, will)
+            with self._lock:
+                previous = self._sessions.get(client_id)
+            if previous:
+                self._end(previous)
+            with self._lock:
+                self._sessions[client_id] = session
+            client.sendall(_encode_packet(_CONNACK, bytes([0, _CONNACK_ACCEPTED])))
+            with self._lock:
+                self.connections += 1
+                self._lock.notify_all()
+            while True:
+                self.reading.wait()
+                packet_type, body = _read_packet(client)
+                if packet_type & 0xf0 == _PUBLISH:
+                    topic, offset = _decode_string(body, 0)
+                    self._record(topic.decode("utf-8"), body[offset:], bool(packet_type & 0x01))
+                elif packet_type & 0xf0 == _PINGREQ:
+                    client.sendall(_encode_packet(_PINGRESP, b""))
+                elif packet_type & 0xf0 == _DISCONNECT:
+                    session.will = None
+                    break
+        except (OSError, MqttError):
+            pass
+        finally:
+            if session:
+                self._end(session)
+            client.close()
+
+    # Drop a session, publishing its last will unless it disconnected cleanly.
+    def _end(self, session):
+        with self._lock:
+            if session.ended:
+                return
+            session.ended = True
+            if self._sessions.get(session.client_id) is session:
+                del self._sessions[session.client_id]
+        try:
+            session.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if session.will and not self._stopping:
+            self._record(*session.will)
+
+    def _record(self, topic, payload, retain):
+        with self._lock:
+            self.messages.append((topic, payload, retain))
+            if retain:
+                self.retained[topic] = payload
+            self._lock.notify_all()
+
+    # Wait until the predicate, called with the lock held, returns true.
+    def wait_for(self, predicate, timeout):
+        with self._lock:
+            return self._lock.wait_for(predicate, timeout)
+
+    def messages_for(self, topic):
+        with self._lock:
+            return [payload for t, payload, retain in self.messages if t == topic]
+
+    # Drop all client connections, as when the broker restarts.
+    def disconnect_clients(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            self._end(session)
+
+    def stop(self):
+        self._stopping = True
+        self.reading.set()
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self.disconnect_clients()
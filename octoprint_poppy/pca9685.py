@@ -2,6 +2,10 @@
 from __future__ import absolute_import
 import math
 from smbus2 import SMBus, i2c_msg
+try:
+    from .i2cdev import prepare_block_read, prepare_block_write
+except ImportError:
+    from i2cdev import prepare_block_read, prepare_block_write
 
 # Refer to datasheet: https://cdn-shop.adafruit.com/datasheets/PCA9685.pdf
 _REGISTER_MODE1 = 0x00
@@ -21,8 +25,9 @@ _CLOCK_FREQ = 25000000
 _DEFAULT_PWM_FREQ = 1200
 
 class PCA9685():
-    def __init__(self, bus_number, unit = 0):
-        self._bus = SMBus(bus_number)
+    def __init__(self, bus, unit = 0):
+        # Accepts an I2C bus number or an already open SMBus-like object.
+        self._bus = SMBus(bus) if isinstance(bus, int) else bus
         self._address = 0x40 + unit
 
     def reset(self, pwm_freq = _DEFAULT_PWM_FREQ):
@@ -57,6 +62,10 @@ class PCA9685():
             raise AttributeError("Invalid pin number")
         return PCA9685.Pin(self, pin)
 
+    # Prepare a write of consecutive registers, relying on auto-increment.
+    def prepare_register_write(self, register, length):
+        return prepare_block_write(self._bus, self._address, register, length)
+
     def close(self):
         self._bus.close()
 
@@ -70,6 +79,13 @@ class PCA9685():
         def __init__(self, io, pin):
             self._io = io
             self._reg = _REGISTER_LED_BASE + pin * 4
+            self._timings_read = prepare_block_read(io._bus, io._address, self._reg, 4)
+            self._timings_write = prepare_block_write(io._bus, io._address, self._reg, 4)
+
+        # First of the pin's four timing registers
+        @property
+        def register(self):
+            return self._reg
 
         # Pin state: False (fully off), True (fully on), or None (unknown)
         @property
@@ -118,7 +134,7 @@ class PCA9685():
         # If off_time is 4096, pin is fully off.
         @property
         def timings(self):
-            data = self._io._bus.read_i2c_block_data(self._io._address, self._reg, 4)
+            data = self._timings_read.execute()
             on_time = (data[1] << 8) + data[0]
             off_time = (data[3] << 8) + data[2]
             return (on_time, off_time)
@@ -129,5 +145,9 @@ class PCA9685():
             off_time = int(values[1])
             if on_time < 0 or on_time > 4096 or off_time < 0 or off_time > 4096:
                 raise AttributeError("Values must be between 0 and 4096")
-            self._io._bus.write_i2c_block_data(self._io._address, self._reg,
-                    [on_time & 0xff, on_time >> 8, off_time & 0xff, off_time >> 8])
+            data = self._timings_write.data
+            data[0] = on_time & 0xff
+            data[1] = on_time >> 8
+            data[2] = off_time & 0xff
+            data[3] = off_time >> 8
+            self._timings_write.execute()
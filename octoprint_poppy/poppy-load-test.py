@@ -0,0 +1,431 @@
+#! /usr/bin/env python3
+# coding=utf-8
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import types
+
+# Runs the real PoppyPlugin against stubbed OctoPrint and Flask modules and a
+# simulated I2C bus, then drives the temperature hook, browser clients, light
+# toggle requests and PSU Control polling concurrently and reports latencies,
+# message rates, bus traffic and fields written from several threads.
+
+_board = None
+
+class _Response():
+    def __init__(self, data = '', status_code = 200, headers = None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = dict(headers or {})
+
+class _Args(dict):
+    def get(self, key, default = None, type = None):
+        value = dict.get(self, key, default)
+        return type(value) if type is not None and value is not None else value
+
+class _Request(threading.local):
+    def __init__(self):
+        self.headers = {}
+        self.args = _Args()
+        self.json = None
+
+    def get_json(self, silent = False):
+        return self.json
+
+def _make_response(data = '', status_code = 200, headers = None):
+    return _Response(data, status_code, headers)
+
+def _jsonify(*args, **kwargs):
+    return _Response(json.dumps(args[0] if args else kwargs), 200,
+            {"Content-Type": "application/json"})
+
+def _install_stubs():
+    octoprint = types.ModuleType("octoprint")
+    plugin = types.ModuleType("octoprint.plugin")
+    for name in ["StartupPlugin", "ShutdownPlugin", "EventHandlerPlugin",
+            "AssetPlugin", "TemplatePlugin", "SimpleApiPlugin"]:
+        setattr(plugin, name, type(name, (object,), {}))
+    plugin.SettingsPlugin = type("SettingsPlugin", (object,), {
+        "on_settings_save": lambda self, data: [self._settings.set([k], v) for k, v in data.items()]
+    })
+    plugin.BlueprintPlugin = type("BlueprintPlugin", (object,), {
+        "route": staticmethod(lambda rule, **kwargs: (lambda f: f))
+    })
+    events = types.ModuleType("octoprint.events")
+    events.Events = type("Events", (object,), dict(
+        CLIENT_OPENED = "ClientOpened",
+        PRINT_STARTED = "PrintStarted",
+        PRINT_DONE = "PrintDone",
+        PRINT_FAILED = "PrintFailed"))
+    util = types.ModuleType("octoprint.util")
+    octoprint.plugin = plugin
+    octoprint.events = events
+    octoprint.util = util
+
+    flask = types.ModuleType("flask")
+    flask.make_response = _make_response
+    flask.jsonify = _jsonify
+    flask.request = _Request()
+
+    smbus2 = types.ModuleType("smbus2")
+    smbus2.SMBus = lambda bus_number: _board_bus(bus_number)
+    smbus2.i2c_msg = None
+
+    sys.modules.update({
+        "octoprint": octoprint,
+        "octoprint.plugin": plugin,
+        "octoprint.events": events,
+        "octoprint.util": util,
+        "flask": flask,
+        "smbus2": smbus2
+    })
+
+def _board_bus(bus_number):
+    from octoprint_poppy.simbus import SimulatedBus
+    return SimulatedBus(_board, bus_number)
+
+class _Settings():
+    def __init__(self, defaults):
+        self._values = dict(defaults)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            return self._values.get(path[0])
+
+    def get_int(self, path):
+        value = self.get(path)
+        return int(value) if value is not None else None
+
+    def get_float(self, path):
+        value = self.get(path)
+        return float(value) if value is not None else None
+
+    def get_boolean(self, path):
+        return bool(self.get(path))
+
+    def set(self, path, value):
+        with self._lock:
+            self._values[path[0]] = value
+
+    def set_int(self, path, value):
+        self.set(path, int(value))
+
+    def save(self):
+        pass
+
+class _PluginManager():
+    def __init__(self):
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def get_helpers(self, *args):
+        return None
+
+    def send_plugin_message(self, identifier, data):
+        json.dumps(data)
+        with self._lock:
+            self.messages += 1
+
+class _EventBus():
+    def __init__(self):
+        self.events = 0
+
+    def fire(self, event, payload = None):
+        self.events += 1
+
+class _OwnedLock():
+    # Wraps a lock to remember which thread holds it, so that the race tracker
+    # only counts a write as guarded when the writing thread holds the lock.
+    def __init__(self, lock):
+        self._lock = lock
+        self._owner = None
+
+    def acquire(self, blocking = True, timeout = -1):
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._owner = threading.get_ident()
+        return acquired
+
+    def release(self):
+        self._owner = None
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def held(self):
+        return self._owner == threading.get_ident()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+_TRACKED_LOCKS = ["_fan_lock", "_light_lock", "_state_lock"]
+
+class _RaceTracker():
+    # Records which threads write each plugin field and whether the writing
+    # thread held one of the plugin's locks at the time.  Fields written from
+    # more than one thread without a lock are reported as potential data races.
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self._writers = {}
+        self._unguarded = {}
+        self._lock = threading.Lock()
+
+    # Replace the plugin's locks with owner-tracking wrappers; call before the
+    # plugin starts its threads.
+    @staticmethod
+    def install_locks(plugin):
+        for name in _TRACKED_LOCKS:
+            setattr(plugin, name, _OwnedLock(getattr(plugin, name)))
+
+    def record(self, name):
+        thread = threading.current_thread().name
+        guarded = any(getattr(self._plugin, lock).held() for lock in _TRACKED_LOCKS)
+        with self._lock:
+            self._writers.setdefault(name, set()).add(thread)
+            if not guarded:
+                self._unguarded.setdefault(name, set()).add(thread)
+
+    def report(self):
+        with self._lock:
+            return dict((name, dict(threads = sorted(threads),
+                    unguarded_threads = sorted(self._unguarded.get(name, ()))))
+                    for name, threads in self._writers.items() if len(threads) > 1)
+
+def _make_plugin_class(base):
+    class TracedPoppyPlugin(base):
+        def __setattr__(self, name, value):
+            tracker = self.__dict__.get("_race_tracker")
+            if tracker is not None:
+                tracker.record(name)
+            base.__setattr__(self, name, value)
+    return TracedPoppyPlugin
+
+class _Call():
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class _HttpServer():
+    # Runs requests one at a time on a single thread, as OctoPrint does on its
+    # Tornado IOLoop, so that a slow or blocking handler delays every client.
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target = self._run, name = "http-server")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                break
+            try:
+                call.result = call.fn(*call.args)
+            except Exception as e:
+                call.error = e
+            call.done.set()
+
+    def call(self, fn, *args):
+        call = _Call(fn, args)
+        self._queue.put(call)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+class _Latencies():
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def measure(self, name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._samples.setdefault(name, []).append(elapsed)
+        return result
+
+    def report(self):
+        report = {}
+        with self._lock:
+            for name, samples in sorted(self._samples.items()):
+                samples = sorted(samples)
+                percentile = lambda p: round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+                report[name] = dict(count = len(samples), p50_ms = percentile(0.5),
+                        p95_ms = percentile(0.95), p99_ms = percentile(0.99),
+                        max_ms = round(samples[-1] * 1000, 3))
+        return report
+
+def _request(flask, plugin_handler, headers = None, args = None, json_body = None):
+    flask.request.headers = headers or {}
+    flask.request.args = _Args(args or {})
+    flask.request.json = json_body
+    return plugin_handler()
+
+def main():
+    global _board
+
+    parser = argparse.ArgumentParser(description = "Poppy plugin load harness")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds to run")
+    parser.add_argument("--clients", type = int, default = 20, help = "simulated browser clients")
+    parser.add_argument("--hook-rate", type = float, default = 4, help = "temperature reports per second")
+    parser.add_argument("--bed-toggle-interval", type = float, default = 1, help = "seconds between bed heating changes")
+    parser.add_argument("--toggle-threads", type = int, default = 4, help = "threads issuing light toggles")
+    parser.add_argument("--toggle-rate", type = float, default = 20, help = "light toggles per second per thread")
+    parser.add_argument("--psu-rate", type = float, default = 10, help = "PSU Control polls per second")
+    parser.add_argument("--bus-delay", type = float, default = 0.0004, help = "seconds per simulated bus transaction")
+    parser.add_argument("--json", action = "store_true", help = "print the report as JSON")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    _install_stubs()
+    import flask
+    import octoprint_poppy
+    from octoprint.events import Events
+    from octoprint_poppy.simbus import SimulatedBoard
+
+    logging.basicConfig(level = logging.WARNING)
+    _board = SimulatedBoard(args.bus_delay)
+    plugin = _make_plugin_class(octoprint_poppy.PoppyPlugin)()
+    plugin._settings = _Settings(plugin.get_settings_defaults())
+    plugin._settings.set(["i2c_transport"], "smbus2")
+    plugin._plugin_manager = _PluginManager()
+    plugin._event_bus = _EventBus()
+    plugin._logger = logging.getLogger("octoprint.plugins.poppy")
+    plugin._identifier = "poppy"
+    plugin._plugin_version = "0.0.0"
+    _RaceTracker.install_locks(plugin)
+    plugin.on_startup("127.0.0.1", 5000)
+    plugin.on_after_startup()
+    plugin._race_tracker = _RaceTracker(plugin)
+
+    latencies = _Latencies()
+    server = _HttpServer()
+    stopping = threading.Event()
+    events = queue.Queue()
+
+    def run_event_dispatcher():
+        while not stopping.is_set():
+            try:
+                event = events.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            latencies.measure("on_event", plugin.on_event, event, {})
+
+    def run_comm():
+        interval = 1 / args.hook_rate
+        bed_target = 0
+        next_toggle = time.monotonic() + args.bed_toggle_interval
+        while not stopping.wait(interval):
+            if time.monotonic() >= next_toggle:
+                bed_target = 0 if bed_target else 100
+                _board.bed_heating = bool(bed_target)
+                next_toggle += args.bed_toggle_interval
+            parsed_temps = {"T0": (210.0, 210.0), "B": (60.0, bed_target)}
+            latencies.measure("get_temperatures", plugin.get_temperatures, None, parsed_temps)
+
+    def run_client():
+        events.put(Events.CLIENT_OPENED)
+        latencies.measure("GET /chamber/history", server.call, _request, flask,
+                plugin.handle_chamber_history_request)
+        etag = None
+        while not stopping.is_set():
+            response = latencies.measure("GET /state", server.call, _request, flask,
+                    plugin.handle_get_state_request, {"If-None-Match": etag} if etag else {})
+            etag = response.headers.get("ETag")
+            stopping.wait(0.5)
+
+    def run_toggles():
+        interval = 1 / args.toggle_rate
+        while not stopping.wait(interval):
+            latencies.measure("POST /chamberLight/toggleMode", server.call, _request, flask,
+                    plugin.handle_toggle_light_mode_request)
+
+    def run_psu_control():
+        interval = 1 / args.psu_rate
+        polls = 0
+        while not stopping.wait(interval):
+            latencies.measure("get_psu_state", plugin.get_psu_state)
+            polls += 1
+            if polls % int(max(args.psu_rate * 2, 1)) == 0:
+                latencies.measure("turn_psu_on/off", plugin.turn_psu_off if plugin.get_psu_state() else plugin.turn_psu_on)
+
+    def run_printer():
+        while not stopping.wait(args.duration / 3):
+            events.put(Events.PRINT_STARTED)
+            if stopping.wait(args.duration / 6):
+                break
+            events.put(Events.PRINT_DONE)
+
+    threads = [threading.Thread(target = run_event_dispatcher, name = "events"),
+            threading.Thread(target = run_comm, name = "comm"),
+            threading.Thread(target = run_psu_control, name = "psucontrol"),
+            threading.Thread(target = run_printer, name = "printer")]
+    threads += [threading.Thread(target = run_client, name = "http-client-%s" % i)
+            for i in range(args.clients)]
+    threads += [threading.Thread(target = run_toggles, name = "http-toggle-%s" % i)
+            for i in range(args.toggle_threads)]
+
+    start_transactions = _board.transactions
+    start_messages = plugin._plugin_manager.messages
+    start = time.monotonic()
+    server.start()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(args.duration)
+    stopping.set()
+    for thread in threads:
+        thread.join()
+    server.stop()
+    elapsed = time.monotonic() - start
+    plugin.on_shutdown()
+
+    report = dict(
+        duration_s = round(elapsed, 2),
+        latencies = latencies.report(),
+        messages_pushed = plugin._plugin_manager.messages - start_messages,
+        messages_per_s = round((plugin._plugin_manager.messages - start_messages) / elapsed, 1),
+        bus_transactions_per_s = round((_board.transactions - start_transactions) / elapsed, 1),
+        chamber_temperature = round(_board.chamber_temperature, 2),
+        races = plugin._race_tracker.report())
+
+    if args.json:
+        print(json.dumps(report, indent = 2, sort_keys = True))
+        return
+    print("duration: %s s" % report["duration_s"])
+    for name, stats in report["latencies"].items():
+        print("  %-32s n %6d  p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms  max %8.3f ms" % (name,
+                stats["count"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+    print("messages pushed: %s (%s/s)" % (report["messages_pushed"], report["messages_per_s"]))
+    print("bus transactions: %s/s" % report["bus_transactions_per_s"])
+    if report["races"]:
+        print("fields written from several threads:")
+        for name, info in sorted(report["races"].items()):
+            print("  %-36s %s%s" % (name, ", ".join(info["threads"]),
+                    "  UNGUARDED: " + ", ".join(info["unguarded_threads"]) if info["unguarded_threads"] else ""))
+
+if __name__ == "__main__":
+    main()
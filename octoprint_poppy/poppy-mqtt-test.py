@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+# coding=utf-8
+from __future__ import absolute_import
+from mqtt import TelemetryExporter
+from mqttbroker import LocalBroker
+import json
+import logging
+import sys
+import time
+
+# Exercises the MQTT telemetry exporter against the in-process broker stand-in:
+# batching and deadbands, an outage with offline buffering, a broker that stops
+# reading, and the last will.  Pass a host and port to watch the exporter
+# publish to a real broker instead.
+
+_INTERVAL = 0.1
+_BUFFER_LENGTH = 5
+_SOCKET_TIMEOUT = 0.5
+_LARGE_PADDING = 1 << 20 # fills the socket buffers in a few snapshots
+
+def state(temperature, fan_speed = 1000, light = 0, padding = 0):
+    fan_status = {"tach_fault": False}
+    if padding:
+        fan_status["padding"] = "x" * padding
+    return {
+        "chamber_temperature": temperature,
+        "chamber_target_temperature": 30,
+        "chamber_fan_speed": fan_speed,
+        "fan_status": fan_status,
+        "chamber_light_mode": light,
+        "psu": True,
+        "chamber_time_to_target": None
+    }
+
+def check(name, condition):
+    print("%s: %s" % ("ok" if condition else "FAILED", name))
+    return condition
+
+def run_local():
+    logging.basicConfig(level = logging.INFO)
+    broker = LocalBroker()
+    exporter = TelemetryExporter("127.0.0.1", broker.port, "poppy-test", "poppy",
+            logging.getLogger("mqtt"), interval = _INTERVAL, buffer_length = _BUFFER_LENGTH,
+            socket_timeout = _SOCKET_TIMEOUT)
+    telemetry = lambda: [json.loads(payload) for payload in broker.messages_for("poppy/telemetry")]
+    ok = True
+    exporter.start()
+    try:
+        exporter.offer(state(25.0))
+        ok &= check("connects and publishes online", broker.wait_for(
+                lambda: broker.retained.get("poppy/status") == b"online", 5))
+        ok &= check("publishes the first snapshot", broker.wait_for(
+                lambda: len(broker.messages_for("poppy/telemetry")) == 1, 5))
+
+        # Many updates within an interval and changes inside the deadband.
+        for i in range(100):
+            exporter.offer(state(25.0 + (i % 3) * 0.1, 1000 + i % 50))
+        time.sleep(_INTERVAL * 5)
+        ok &= check("deadband suppresses small changes", len(telemetry()) == 1)
+        exporter.offer(state(26.0))
+        exporter.offer(state(27.0, light = 2))
+        broker.wait_for(lambda: len(broker.messages_for("poppy/telemetry")) == 2, 5)
+        last = telemetry()[-1]
+        ok &= check("batches updates into the latest snapshot",
+                len(telemetry()) == 2 and last["chamber_temperature"] == 27.0
+                and last["chamber_light_mode"] == 2)
+
+        # Outage: snapshots queue up to the bound and drain after reconnecting.
+        broker.online = False
+        broker.disconnect_clients()
+        for i in range(8):
+            exporter.offer(state(30.0 + i))
+            time.sleep(_INTERVAL * 2)
+        ok &= check("buffers while offline", not exporter.connected and exporter.queued == _BUFFER_LENGTH)
+        # The first snapshot after the drop may still go to the dead socket.
+        ok &= check("drops the oldest beyond the bound", exporter.dropped >= 2)
+        broker.online = True
+        ok &= check("reconnects and drains", broker.wait_for(
+                lambda: len(broker.messages_for("poppy/telemetry")) == 7, 10))
+        ok &= check("drains in order", [t["chamber_temperature"] for t in telemetry()[2:]]
+                == [33.0, 34.0, 35.0, 36.0, 37.0])
+
+        # A broker that stops reading: large snapshots fill the socket buffers,
+        # offers keep returning at once, the queue stays bounded, and the
+        # exporter drops the stalled connection after the socket timeout and
+        # connects again, taking over its session.
+        broker.reading.clear()
+        connections = broker.connections
+        dropped = exporter.dropped
+        slowest_offer = 0
+        longest_queue = 0
+        deadline = time.monotonic() + 10
+        i = 0
+        while broker.connections <= connections and time.monotonic() < deadline:
+            start = time.monotonic()
+            exporter.offer(state(40.0 + i, padding = _LARGE_PADDING))
+            slowest_offer = max(slowest_offer, time.monotonic() - start)
+            longest_queue = max(longest_queue, exporter.queued)
+            i += 1
+            time.sleep(_INTERVAL / 2)
+        ok &= check("offers never block", slowest_offer < 0.05)
+        ok &= check("queue stays bounded while stalled",
+                longest_queue <= _BUFFER_LENGTH and exporter.dropped > dropped)
+        ok &= check("drops the stalled connection and reconnects", broker.connections > connections)
+        exporter.offer(state(42.0))
+        broker.reading.set()
+        ok &= check("recovers once the broker reads again", broker.wait_for(
+                lambda: exporter.connected and exporter.queued == 0
+                and broker.retained.get("poppy/status") == b"online", 10))
+
+        # The last will marks the printer offline when the connection drops,
+        # until the exporter reconnects.  Refuse connections meanwhile so that
+        # the will can be observed before the exporter is back online.
+        statuses = len(broker.messages_for("poppy/status"))
+        connections = broker.connections
+        broker.online = False
+        broker.disconnect_clients()
+        ok &= check("publishes the last will on an unclean drop", broker.wait_for(
+                lambda: broker.retained.get("poppy/status") == b"offline", 5)
+                and broker.messages_for("poppy/status")[statuses:] == [b"offline"])
+        broker.online = True
+        ok &= check("reconnects after a drop and publishes online", broker.wait_for(
+                lambda: broker.connections > connections
+                and broker.retained.get("poppy/status") == b"online", 10))
+    finally:
+        exporter.stop()
+    ok &= check("publishes offline on stop", broker.wait_for(
+            lambda: broker.retained.get("poppy/status") == b"offline", 5))
+    broker.stop()
+    print("published %s, dropped %s" % (exporter.published, exporter.dropped))
+    sys.exit(0 if ok else 1)
+
+def run_remote(host, port):
+    logging.basicConfig(level = logging.INFO)
+    exporter = TelemetryExporter(host, port, "poppy-test", "poppy", logging.getLogger("mqtt"))
+    exporter.start()
+    try:
+        temperature = 25.0
+        while True:
+            temperature += 0.2
+            exporter.offer(state(round(temperature, 1)))
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.stop()
+
+def main():
+    if len(sys.argv) == 1:
+        run_local()
+    elif len(sys.argv) == 3:
+        run_remote(sys.argv[1], int(sys.argv[2]))
+    else:
+        print("Usage: %s [<host> <port>]" % sys.argv[0])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+# coding=utf-8
+from __future__ import absolute_import
+from emc2101 import EMC2101
+from i2ctrace import ReplayMismatchError, TraceRecorder, TraceReplay
+import collections
+import sys
+import time
+
+# Records the fan controller's I2C traffic into a trace, or replays a trace
+# (such as one captured by the plugin's i2c_trace_file setting) through the
+# EMC2101 driver and reports poll latency and the faults it contained.
+
+def record(path, seconds):
+    from smbus2 import SMBus
+    recorder = TraceRecorder(path)
+    try:
+        with EMC2101(recorder.wrap(SMBus(11))) as fan:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                try:
+                    fan.poll()
+                except OSError as e:
+                    print("poll failed: %s" % e)
+                time.sleep(1.0 / 16)
+    finally:
+        recorder.close()
+    print("recorded %s seconds to %s" % (seconds, path))
+
+def replay(path, speed):
+    replay = TraceReplay(path, speed, strict = False)
+    fan = EMC2101(replay.bus())
+    latencies = []
+    errors = collections.Counter()
+    faults = collections.Counter()
+    temperatures = []
+    start = time.monotonic()
+    while True:
+        poll_start = time.perf_counter()
+        try:
+            fan.poll()
+        except EOFError:
+            break
+        except ReplayMismatchError as e:
+            print("trace diverged: %s" % e)
+            break
+        except OSError as e:
+            errors[e.errno] += 1
+            continue
+        latencies.append(time.perf_counter() - poll_start)
+        temperatures.append(fan.external_temperature)
+        for name, value in fan.status.items():
+            if value:
+                faults[name] += 1
+        if fan.fan_speed == 0:
+            faults["fan_stopped"] += 1
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    print("replayed %s records in %.2f s at speed %s" % (replay.records, elapsed, speed))
+    print("polls: %s" % len(latencies))
+    if latencies:
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+        print("poll latency: p50 %.3f ms, p99 %.3f ms, max %.3f ms" %
+                (percentile(0.5), percentile(0.99), latencies[-1] * 1000))
+        print("external temperature: min %s, max %s" % (min(temperatures), max(temperatures)))
+    print("bus errors: %s" % dict(errors))
+    print("faults: %s" % dict(faults))
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "record":
+        record(sys.argv[2], float(sys.argv[3]))
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "replay":
+        replay(sys.argv[2], float(sys.argv[3]) if len(sys.argv) == 4 else 0)
+    else:
+        print("Usage: %s record <trace> <seconds> | replay <trace> [<speed>]" % sys.argv[0])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
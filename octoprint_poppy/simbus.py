@@ -0,0 +1,161 @@
+# coding=utf-8
+from __future__ import absolute_import
+import threading
+import time
+
+# Simulated I2C bus with the chips found on a Poppy board, for exercising the
+# drivers and the plugin without hardware.  The bus mimics the subset of the
+# smbus2.SMBus interface that the drivers use.
+
+_EMC2101_ADDRESS = 0x4c
+_PCA9685_ADDRESS = 0x40
+_AW9523_ADDRESS = 0x58
+
+_I2C_M_RD = 0x0001
+
+# Roughly the time taken by a register read at 100 kHz.
+_DEFAULT_TRANSACTION_DELAY_SECONDS = 0.0004
+
+class SimulatedBoard():
+    # Register files and a crude thermal model of the chamber shared by all
+    # buses opened on the board.
+    def __init__(self, transaction_delay = _DEFAULT_TRANSACTION_DELAY_SECONDS):
+        self.transaction_delay = transaction_delay
+        self.transactions = 0
+        self.ambient_temperature = 22.0
+        self.chamber_temperature = 22.0
+        self.bed_heating = False
+        self.max_fan_speed = 3000
+        self.inputs = 0
+        self._lock = threading.Lock()
+        self._last_step = time.monotonic()
+        self._registers = {
+            _EMC2101_ADDRESS: bytearray(256),
+            _PCA9685_ADDRESS: bytearray(256),
+            _AW9523_ADDRESS: bytearray(256)
+        }
+        self._registers[_EMC2101_ADDRESS][0xfd] = 0x16
+        self._registers[_EMC2101_ADDRESS][0xfe] = 0x5d
+        self._registers[_AW9523_ADDRESS][0x10] = 0x23
+
+    def _transaction(self):
+        # Called with the lock held so that concurrent buses serialize like a real bus.
+        self.transactions += 1
+        if self.transaction_delay:
+            time.sleep(self.transaction_delay)
+
+    def _registers_for(self, address):
+        try:
+            return self._registers[address]
+        except KeyError:
+            raise OSError(121, "Remote I/O error")
+
+    def _read(self, address, register, length):
+        registers = self._registers_for(address)
+        if address == _EMC2101_ADDRESS:
+            self._step()
+        elif address == _AW9523_ADDRESS:
+            registers[0x00] = self.inputs & 0xff
+            registers[0x01] = self.inputs >> 8
+        return bytes(registers[(register + i) & 0xff] for i in range(length))
+
+    def _write(self, address, register, data):
+        registers = self._registers_for(address)
+        for i, value in enumerate(data):
+            registers[(register + i) & 0xff] = value
+
+    def _fan_duty_cycle(self):
+        # Fraction of full duty the EMC2101 would drive, following the LUT unless
+        # the fan setting register is in control.
+        registers = self._registers[_EMC2101_ADDRESS]
+        full = max(registers[0x4d] * 2, 1)
+        if registers[0x4a] & 0x20:
+            setting = registers[0x4c]
+        else:
+            setting = 0
+            for index in range(8):
+                if self.chamber_temperature >= registers[0x50 + index * 2]:
+                    setting = registers[0x51 + index * 2]
+        return min(setting / full, 1.0)
+
+    def _step(self):
+        now = time.monotonic()
+        dt = now - self._last_step
+        self._last_step = now
+        duty = self._fan_duty_cycle()
+        equilibrium = self.ambient_temperature + (30 if self.bed_heating else 0)
+        self.chamber_temperature += dt * ((equilibrium - self.chamber_temperature) / 600
+                - duty * (self.chamber_temperature - self.ambient_temperature) / 120)
+
+        registers = self._registers[_EMC2101_ADDRESS]
+        registers[0x00] = int(self.ambient_temperature + 5)
+        registers[0x01] = int(self.chamber_temperature) & 0xff
+        registers[0x10] = int((self.chamber_temperature % 1) * 8) << 5
+        rpm = duty * self.max_fan_speed
+        count = int(5400000 / rpm) if rpm > 0 else 0xffff
+        registers[0x46] = count & 0xff
+        registers[0x47] = (count >> 8) & 0xff
+
+class SimulatedBus():
+    def __init__(self, board, bus_number = None):
+        self._board = board
+        self.bus_number = bus_number
+
+    def read_byte_data(self, address, register):
+        with self._board._lock:
+            self._board._transaction()
+            return self._board._read(address, register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        with self._board._lock:
+            self._board._transaction()
+            self._board._write(address, register, [value])
+
+    def read_i2c_block_data(self, address, register, length):
+        with self._board._lock:
+            self._board._transaction()
+            return list(self._board._read(address, register, length))
+
+    def write_i2c_block_data(self, address, register, data):
+        with self._board._lock:
+            self._board._transaction()
+            self._board._write(address, register, data)
+
+    def i2c_rdwr(self, *messages):
+        # Each write message selects a register and writes any remaining bytes,
+        # each read message continues from the last selected register.
+        with self._board._lock:
+            self._board._transaction()
+            register = 0
+            for message in messages:
+                if message.flags & _I2C_M_RD:
+                    data = self._board._read(message.addr, register, message.len)
+                    message.buf[0:message.len] = data
+                    register += message.len
+                else:
+                    payload = bytes(message.buf[0:message.len])
+                    register = payload[0]
+                    self._board._write(message.addr, register, payload[1:])
+                    register += len(payload) - 1
+
+    def close(self):
+        pass
+
+class SimulatedMessage():
+    # Stand-in for smbus2.i2c_msg backed by a bytearray.
+    def __init__(self, addr, flags, buf):
+        self.addr = addr
+        self.flags = flags
+        self.buf = bytearray(buf)
+        self.len = len(self.buf)
+
+    @staticmethod
+    def read(address, length):
+        return SimulatedMessage(address, _I2C_M_RD, bytes(length))
+
+    @staticmethod
+    def write(address, data):
+        return SimulatedMessage(address, 0, data)
+
+    def __iter__(self):
+        return iter(self.buf)
@@ -1,4 +1,126 @@
 $(function() {
+    var SPARKLINE_CAPACITY = 300;
+    var SPARKLINE_WINDOW_MS = 10 * 60 * 1000;
+    var SPARKLINE_TEMPERATURE_COLOR = "#ff8040";
+    var SPARKLINE_FAN_SPEED_COLOR = "#80c0ff";
+
+    // Draws chamber temperature and fan speed history into a small canvas.
+    // Samples are kept in a fixed-size ring of typed arrays and redraws are
+    // batched to at most one per animation frame while the page is visible.
+    function Sparkline(canvas) {
+        var self = this;
+
+        self.canvas = canvas;
+        self.times = new Float64Array(SPARKLINE_CAPACITY);
+        self.temperatures = new Float32Array(SPARKLINE_CAPACITY);
+        self.fanSpeeds = new Float32Array(SPARKLINE_CAPACITY);
+        self.head = 0;
+        self.count = 0;
+        self.drawPending = false;
+        self.dirty = false;
+
+        self.append = function(time, temperature, fanSpeed) {
+            self.times[self.head] = time;
+            self.temperatures[self.head] = temperature;
+            self.fanSpeeds[self.head] = fanSpeed;
+            self.head = (self.head + 1) % SPARKLINE_CAPACITY;
+            if (self.count < SPARKLINE_CAPACITY) {
+                self.count++;
+            }
+            self.scheduleDraw();
+        };
+
+        // Inserts samples older than the ones already received, such as history
+        // fetched from the server after live updates have started arriving.
+        self.backfill = function(samples) {
+            var oldest = self.count > 0 ? self.times[self.index(0)] : Infinity;
+            var live = [];
+            for (var i = 0; i < self.count; i++) {
+                var j = self.index(i);
+                live.push([self.times[j], self.temperatures[j], self.fanSpeeds[j]]);
+            }
+            self.head = 0;
+            self.count = 0;
+            samples.forEach(function(sample) {
+                if (sample[0] < oldest) {
+                    self.append(sample[0], sample[1], sample[2]);
+                }
+            });
+            live.forEach(function(sample) {
+                self.append(sample[0], sample[1], sample[2]);
+            });
+        };
+
+        self.index = function(i) {
+            return (self.head - self.count + i + SPARKLINE_CAPACITY) % SPARKLINE_CAPACITY;
+        };
+
+        self.scheduleDraw = function() {
+            if (document.hidden) {
+                self.dirty = true;
+                return;
+            }
+            if (!self.drawPending) {
+                self.drawPending = true;
+                window.requestAnimationFrame(self.draw);
+            }
+        };
+
+        self.draw = function() {
+            self.drawPending = false;
+            self.dirty = false;
+
+            var context = self.canvas.getContext("2d");
+            context.clearRect(0, 0, self.canvas.width, self.canvas.height);
+            if (self.count < 2) {
+                return;
+            }
+            var end = self.times[self.index(self.count - 1)];
+            self.drawSeries(context, self.fanSpeeds, end, SPARKLINE_FAN_SPEED_COLOR);
+            self.drawSeries(context, self.temperatures, end, SPARKLINE_TEMPERATURE_COLOR);
+        };
+
+        self.drawSeries = function(context, values, end, color) {
+            var start = end - SPARKLINE_WINDOW_MS;
+            var min = Infinity;
+            var max = -Infinity;
+            var first = 0;
+            for (var i = self.count - 1; i >= 0; i--) {
+                var j = self.index(i);
+                if (self.times[j] < start) {
+                    first = i;
+                    break;
+                }
+                min = Math.min(min, values[j]);
+                max = Math.max(max, values[j]);
+            }
+            var range = Math.max(max - min, 1);
+            var width = self.canvas.width;
+            var height = self.canvas.height - 2;
+
+            context.strokeStyle = color;
+            context.lineWidth = 1;
+            context.beginPath();
+            for (var i = first; i < self.count; i++) {
+                var j = self.index(i);
+                var x = Math.max(self.times[j] - start, 0) * width / SPARKLINE_WINDOW_MS;
+                var y = 1 + height - (Math.min(Math.max(values[j], min), max) - min) * height / range;
+                if (i == first) {
+                    context.moveTo(x, y);
+                } else {
+                    context.lineTo(x, y);
+                }
+            }
+            context.stroke();
+        };
+
+        document.addEventListener("visibilitychange", function() {
+            if (!document.hidden && self.dirty) {
+                self.scheduleDraw();
+            }
+        });
+    }
+
     function PoppyViewModel(parameters) {
         var self = this;
 
@@ -8,10 +130,24 @@ $(function() {
 
         self.chamberTemperature = ko.observable(undefined);
         self.chamberFanSpeed = ko.observable(undefined);
+        self.chamberTimeToTarget = ko.observable(undefined);
+        self.chamberTimeToTargetText = ko.pureComputed(function() {
+            var seconds = self.chamberTimeToTarget();
+            if (seconds === undefined || seconds === null || seconds <= 0) {
+                return undefined;
+            }
+            return seconds < 60 ? "<1 min" : Math.round(seconds / 60) + " min";
+        });
+
+        self.chamberSparkline = new Sparkline(document.getElementById("poppy_chamber_sparkline"));
+        self.chamberHistoryRequested = false;
 
         self.chamberLightIndicator = $("#poppy_chamber_light_indicator");
         self.chamberLightMode = ko.observable(undefined);
 
+        self.fanCharacterizing = ko.observable(false);
+        self.fanProfile = ko.observable(false);
+
         self.onBeforeBinding = function() {
             self.settings = self.settingsViewModel.settings;
         }
@@ -36,17 +172,57 @@ $(function() {
             });
         };
 
+        self.onStartupComplete = function() {
+            self.requestChamberHistory();
+        };
+
+        self.onUserLoggedIn = function() {
+            self.requestChamberHistory();
+        };
+
+        self.requestChamberHistory = function() {
+            if (self.chamberHistoryRequested || !self.loginState.isUser()) {
+                return;
+            }
+            self.chamberHistoryRequested = true;
+            $.getJSON(BASEURL + "plugin/poppy/chamber/history", function(response) {
+                var now = Date.now();
+                self.chamberSparkline.backfill(response.samples.map(function(sample) {
+                    return [now - sample[0] * 1000, sample[1], sample[2]];
+                }));
+            }).fail(function() {
+                self.chamberHistoryRequested = false;
+            });
+        };
+
         self.onDataUpdaterPluginMessage = function(plugin, data) {
             if (plugin == "poppy") {
+                // Every message carries the telemetry, so only record a sample
+                // when it changed, not for light toggles or reconnecting tabs.
+                var temperature = self.chamberTemperature();
+                var fanSpeed = self.chamberFanSpeed();
                 if (data.chamber_temperature !== undefined) {
                     self.chamberTemperature(data.chamber_temperature);
                 }
                 if (data.chamber_fan_speed !== undefined) {
                     self.chamberFanSpeed(data.chamber_fan_speed);
                 }
+                if (self.chamberTemperature() !== temperature || self.chamberFanSpeed() !== fanSpeed) {
+                    self.chamberSparkline.append(Date.now(),
+                        self.chamberTemperature() || 0, self.chamberFanSpeed() || 0);
+                }
+                if (data.chamber_time_to_target !== undefined) {
+                    self.chamberTimeToTarget(data.chamber_time_to_target);
+                }
                 if (data.chamber_light_mode !== undefined) {
                     self.chamberLightMode(data.chamber_light_mode);
                 }
+                if (data.fan_characterizing !== undefined) {
+                    self.fanCharacterizing(data.fan_characterizing);
+                }
+                if (data.fan_profile !== undefined) {
+                    self.fanProfile(data.fan_profile);
+                }
             }
         };
 
@@ -54,6 +230,14 @@ $(function() {
             $.post(BASEURL + "plugin/poppy/chamberLight/toggleMode");
         };
 
+        self.characterizeFan = function() {
+            $.post(BASEURL + "plugin/poppy/fan/characterize");
+        };
+
+        self.resetFanProfile = function() {
+            $.ajax({ url: BASEURL + "plugin/poppy/fan/profile", type: "DELETE" });
+        };
+
         self.showSettings = function() {
             self.settingsViewModel.show("#settings_plugin_poppy");
         };
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import absolute_import
+import math
+
+# The model predicts the rate of change of the chamber temperature in degrees
+# per minute from a small set of features:
+#
+#   dT/dt = a + b * T + c * bed_heating + d * fan_speed / _FAN_SPEED_SCALE
+#
+# With the inputs held constant this is a first order system that settles at
+# T_eq = -(a + c * bed_heating + d * fan) / b, which gives a closed form for the
+# time to reach a target.  The parameters are fitted with recursive least squares
+# so each sample costs a fixed amount of work regardless of the history length.
+_FEATURE_COUNT = 4
+_FAN_SPEED_SCALE = 1000.0
+_FORGETTING_FACTOR = 0.998
+_INITIAL_COVARIANCE = 100.0
+_MAX_COVARIANCE_TRACE = 1e4
+_TEMPERATURE_SMOOTHING = 0.25
+_MIN_SAMPLES = 30
+_TARGET_TOLERANCE = 0.25
+
+class ChamberThermalModel():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._theta = [0.0] * _FEATURE_COUNT
+        self._p = [[_INITIAL_COVARIANCE if i == j else 0.0 for j in range(_FEATURE_COUNT)]
+                for i in range(_FEATURE_COUNT)]
+        self._samples = 0
+        self._last_time = None
+        self._temperature = None
+        self._features = None
+
+    # Add a sample: monotonic time in seconds, chamber temperature, whether the bed
+    # is heating, and the fan speed in rpm.
+    def update(self, timestamp, temperature, bed_heating, fan_speed):
+        if temperature is None:
+            return
+        if self._last_time is None:
+            self._last_time = timestamp
+            self._temperature = temperature
+            self._features = self._make_features(temperature, bed_heating, fan_speed)
+            return
+        dt = timestamp - self._last_time
+        if dt <= 0:
+            return
+
+        # Smooth the temperature to suppress quantization noise in the derivative.
+        temperature = self._temperature + _TEMPERATURE_SMOOTHING * (temperature - self._temperature)
+        rate = (temperature - self._temperature) * 60 / dt
+        self._fit(self._features, rate)
+
+        self._last_time = timestamp
+        self._temperature = temperature
+        self._features = self._make_features(temperature, bed_heating, fan_speed)
+        self._samples += 1
+
+    def _make_features(self, temperature, bed_heating, fan_speed):
+        return (1.0, float(temperature), 1.0 if bed_heating else 0.0,
+                (fan_speed or 0) / _FAN_SPEED_SCALE)
+
+    def _fit(self, x, y):
+        n = _FEATURE_COUNT
+        p = self._p
+        px = [sum(p[i][j] * x[j] for j in range(n)) for i in range(n)]
+        denominator = _FORGETTING_FACTOR + sum(x[i] * px[i] for i in range(n))
+        gain = [v / denominator for v in px]
+        error = y - sum(self._theta[i] * x[i] for i in range(n))
+        for i in range(n):
+            self._theta[i] += gain[i] * error
+
+        # Stop forgetting once the covariance grows too large, which happens when
+        # the inputs stay constant for a long time and would otherwise wind up.
+        trace = sum(p[i][i] for i in range(n))
+        forgetting = _FORGETTING_FACTOR if trace < _MAX_COVARIANCE_TRACE else 1.0
+        for i in range(n):
+            for j in range(n):
+                p[i][j] = (p[i][j] - gain[i] * px[j]) / forgetting
+
+    @property
+    def ready(self):
+        return self._samples >= _MIN_SAMPLES
+
+    @property
+    def temperature(self):
+        return self._temperature
+
+    # Temperature at which the chamber settles with the given inputs, or None if unknown.
+    def equilibrium_temperature(self, bed_heating, fan_speed):
+        if not self.ready:
+            return None
+        x = self._make_features(0, bed_heating, fan_speed)
+        offset = self._theta[0] + self._theta[2] * x[2] + self._theta[3] * x[3]
+        slope = self._theta[1]
+        if slope >= 0:
+            return None
+        return -offset / slope
+
+    # Estimated time in seconds to reach the target temperature with the given inputs,
+    # 0 if already there, or None if unknown or not reachable.
+    def time_to_target(self, target, bed_heating, fan_speed):
+        if not self.ready or target is None:
+            return None
+        temperature = self._temperature
+        if abs(target - temperature) <= _TARGET_TOLERANCE:
+            return 0
+        equilibrium = self.equilibrium_temperature(bed_heating, fan_speed)
+        if equilibrium is None:
+            return None
+        if not (min(temperature, equilibrium) < target < max(temperature, equilibrium)):
+            return None
+        minutes = math.log((target - equilibrium) / (temperature - equilibrium)) / self._theta[1]
+        return minutes * 60